@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+
+# Benchmarks for the motion detection path.
+#
+# Generates a synthetic sequence of camera frames (one of png.py's test
+# patterns as the scene, with square objects moving across it), encodes
+# them with png.Writer as the images service would, and then times each
+# stage of the detection path on its own:
+#
+#   decode        png decode to integer samples (modetect.decode_png)
+#   decode_float  png decode to floating point samples (png.Reader.asFloat)
+#   luma          integer RGB to luma conversion (modetect.to_luma)
+#   compare       full frame difference (modetect.compare_frames)
+#   compare_coarse  subsampled difference used by the coarse pass
+#   compare_tiled frame difference over a 4x4 tile grid
+#   ewma          EWMA update and motion rating
+#   background    BackgroundModel update (the "background" reference)
+#   background_load  BackgroundModel.fromstring, as on a background cache miss
+#   detect        modetect.detect_motion, start to finish, after decoding
+#   detect_luma   the same in luma mode, including the conversion to luma
+#
+# Results are written one stage per line as "name<TAB>microseconds per
+# frame", preceded by "#" comment lines describing the run.  Given a
+# baseline file in the same format (see bench_baseline.txt), every stage is
+# compared against it and the exit status is 1 when any stage is slower by
+# more than the tolerance, and by more than an absolute floor (so that the
+# quickest stages do not fail on noise).  Quick stages are called repeatedly
+# until at least MIN_RUN_TIME has passed.  The run uses the baseline's engine
+# unless another is asked for; a baseline recorded with a different engine or
+# sequence is refused, since its timings are not comparable.  Typical use:
+#
+#   python bench.py -o bench_output.txt -b bench_baseline.txt
+
+import sys, time, optparse, png, modetect
+from array import array
+from cStringIO import StringIO
+
+try:
+    from timeit import default_timer as timer
+except ImportError:
+    timer = time.time
+
+
+# ----------------------------------------------------------------------
+
+# Generate a list of PNG images making up a sequence of nframes frames.
+# The scene is built from png.py's test patterns (one per colour plane);
+# every object is a square of objsize pixels which moves by speed pixels per
+# frame, each along a different diagonal, wrapping at the frame edges.
+def make_sequence(size=100, nframes=20, objects=1, objsize=10, speed=3,
+                  patterns=("GTB", "GLR", "RTL")):
+    red, green, blue = patterns
+    scene = png.test_rgba(size, 8, red, green, blue)
+    writer = png.Writer(size, size, bitdepth=8)
+    sequence = []
+    for n in range(nframes):
+        pixels = array('B', scene)
+        for i in range(objects):
+            x0 = (i * size // max(objects, 1) + n * speed) % size
+            y0 = (i * size // max(objects, 1) + n * speed * (1 + i % 2)) % size
+            colour = [(255 * (i + 1) // objects) & 0xff, 0, 255]
+            for y in range(y0, min(y0 + objsize, size)):
+                for x in range(x0, min(x0 + objsize, size)):
+                    p = 3 * (y * size + x)
+                    pixels[p:p + 3] = array('B', colour)
+        out = StringIO()
+        writer.write_array(out, pixels)
+        sequence.append(out.getvalue())
+    return sequence
+
+
+# Shortest time, in seconds, that a single run of a stage is timed over.
+# Quick stages are called repeatedly until this much time has passed, so that
+# timer resolution and scheduling noise stay small against the measurement.
+MIN_RUN_TIME = 0.001
+
+
+# Return the fastest of repeat runs of func(), in seconds per call.
+def best_time(func, repeat):
+    best = None
+    for i in range(repeat):
+        calls = 0
+        start = timer()
+        while True:
+            func()
+            calls += 1
+            elapsed = timer() - start
+            if elapsed >= MIN_RUN_TIME:
+                break
+        elapsed /= calls
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+# Time every stage over the sequence.  Returns a list of (stage, seconds
+# per frame), in the order the stages run in.
+def run(sequence, repeat=3, engine=None):
+    engine = modetect.get_engine(engine)
+    # The background model has its own numpy switch; keep the whole run on
+    # the engine asked for.
+    modetect.BackgroundModel.use_numpy = engine.name == 'numpy'
+    nframes = len(sequence)
+    frames = [modetect.decode_png(data) for data in sequence]
+    pairs = zip(frames[:-1], frames[1:])
+    width, height = frames[0][0], frames[0][1]
+    grid = modetect.TileGrid(width, height, 4, 4)
+    params = modetect.MotionParams()
+    amounts = [modetect.compare_frames(prev, cur, None, 1, engine)[0] for prev, cur in pairs]
+    info = frames[0][3]
+
+    def background_model():
+        return modetect.BackgroundModel(width, height, info['planes'], info['bitdepth'],
+                                        params.background_shift, params.background_variance)
+    model = background_model()
+    for frame in frames:
+        model.update(frame[2])
+    stored = model.tostring()
+
+    def decode():
+        for data in sequence:
+            modetect.decode_png(data)
+
+    def decode_float():
+        for data in sequence:
+            for row in png.Reader(bytes=data).asFloat()[2]:
+                pass
+
+    def luma():
+        for frame in frames:
+            modetect.to_luma(frame, engine)
+
+    def compare():
+        for prev, cur in pairs:
+            modetect.compare_frames(prev, cur, None, 1, engine)
+
+    def compare_coarse():
+        for prev, cur in pairs:
+            modetect.compare_frames(prev, cur, None, params.coarse_step, engine)
+
+    def compare_tiled():
+        for prev, cur in pairs:
+            modetect.compare_frames(prev, cur, grid, 1, engine)
+
+    def ewma():
+        value = None
+        for amount in amounts:
+            modetect.motion_rating(amount, value)
+            value = modetect.update_ewma(value, amount, params.ewma_alpha)
+
+    def background():
+        model = background_model()
+        for frame in frames:
+            model.update(frame[2])
+
+    def background_load():
+        for frame in frames:
+            modetect.BackgroundModel.fromstring(stored)
+
+    def detect():
+        state = modetect.MotionState()
+        for frame in frames:
+            modetect.detect_motion(frame, state, params, engine)
+
+    luma_params = modetect.MotionParams(mode="luma")
+    def detect_luma():
+        state = modetect.MotionState()
+        for frame in frames:
+            frame = modetect.prepare_frame(frame, luma_params, engine)
+            modetect.detect_motion(frame, state, luma_params, engine)
+
+    results = []
+    for stage, func, count in [("decode", decode, nframes),
+                               ("decode_float", decode_float, nframes),
+                               ("luma", luma, nframes),
+                               ("compare", compare, len(pairs)),
+                               ("compare_coarse", compare_coarse, len(pairs)),
+                               ("compare_tiled", compare_tiled, len(pairs)),
+                               ("ewma", ewma, len(amounts)),
+                               ("background", background, nframes),
+                               ("background_load", background_load, nframes),
+                               ("detect", detect, nframes),
+                               ("detect_luma", detect_luma, nframes)]:
+        results.append((stage, best_time(func, repeat) / count))
+    return results
+
+
+# ----------------------------------------------------------------------
+
+def write_results(out, results, comments=()):
+    for line in comments:
+        out.write("# %s\n" % line)
+    for stage, seconds in results:
+        out.write("%s\t%.3f\n" % (stage, seconds * 1e6))
+
+
+# Read a results file back.  Returns a dict of stage -> seconds per frame,
+# and a dict of the "# name value" comment lines describing the run (such as
+# "engine" and "size").
+def read_results(infile):
+    results = {}
+    header = {}
+    for line in infile:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith("#"):
+            name, sep, value = line[1:].strip().partition(" ")
+            header[name] = value.strip()
+            continue
+        stage, usec = line.split("\t")
+        results[stage] = float(usec) / 1e6
+    return results, header
+
+
+# Compare results against a baseline.  Returns a list of (stage, ratio)
+# for the stages more than tolerance times slower than the baseline, and
+# also slower by more than floor seconds per frame (so that the noise of
+# stages taking a microsecond or two is not reported).
+def regressions(results, baseline, tolerance, floor=0.0):
+    slower = []
+    for stage, seconds in results:
+        if baseline.get(stage):
+            ratio = seconds / baseline[stage]
+            if ratio > tolerance and seconds - baseline[stage] > floor:
+                slower.append((stage, ratio))
+    return slower
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-S", "--size", type="int", default=100,
+                      help="width and height of the frames (default: %default)")
+    parser.add_option("-n", "--frames", type="int", default=20,
+                      help="number of frames in the sequence (default: %default)")
+    parser.add_option("-k", "--objects", type="int", default=1,
+                      help="number of moving objects (default: %default)")
+    parser.add_option("-z", "--object-size", type="int", default=10,
+                      help="size of the moving objects in pixels (default: %default)")
+    parser.add_option("-v", "--speed", type="int", default=3,
+                      help="pixels an object moves per frame (default: %default)")
+    parser.add_option("-r", "--repeat", type="int", default=3,
+                      help="runs per stage; the fastest is reported (default: %default)")
+    parser.add_option("-e", "--engine", help="difference engine (default: fastest available)")
+    parser.add_option("-o", "--output", help="results file (default: stdout)")
+    parser.add_option("-b", "--baseline", help="baseline results file to compare against")
+    parser.add_option("-t", "--tolerance", type="float", default=1.25,
+                      help="slowdown relative to the baseline that counts as a regression (default: %default)")
+    parser.add_option("-f", "--floor", type="float", default=2.0,
+                      help="smallest slowdown in microseconds per frame that counts as a regression (default: %default)")
+    (options, args) = parser.parse_args(argv)
+
+    baseline = None
+    if options.baseline:
+        baseline, header = read_results(open(options.baseline))
+        if options.engine is None:
+            options.engine = header.get("engine")
+
+    try:
+        engine = modetect.get_engine(options.engine)
+    except ValueError, e:
+        parser.error(str(e))
+    comments = ["python %s" % sys.version.split()[0],
+                "engine %s" % engine.name,
+                "size %d frames %d objects %d object_size %d speed %d" %
+                (options.size, options.frames, options.objects, options.object_size, options.speed)]
+    if baseline is not None:
+        for line in comments[1:]:
+            name, value = line.split(" ", 1)
+            if header.get(name, value) != value:
+                parser.error("baseline %s has %s %s, this run %s" %
+                             (options.baseline, name, header[name], value))
+
+    sequence = make_sequence(options.size, options.frames, options.objects,
+                             options.object_size, options.speed)
+    results = run(sequence, options.repeat, engine.name)
+    if options.output:
+        out = open(options.output, "w")
+        write_results(out, results, comments)
+        out.close()
+    else:
+        write_results(sys.stdout, results, comments)
+
+    if baseline is not None:
+        slower = regressions(results, baseline, options.tolerance,
+                             options.floor / 1e6)
+        for stage, ratio in slower:
+            sys.stderr.write("%s: %.2fx slower than baseline\n" % (stage, ratio))
+        if slower:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,7 +6,7 @@ from google.appengine.api import memcache, urlfetch, images, users
 from google.appengine.api.labs import taskqueue
 from google.appengine.runtime import DeadlineExceededError, apiproxy_errors
 from datetime import datetime, timedelta
-import os, urllib, cgi, png, time, base64
+import os, urllib, cgi, time, base64, modetect
 from schema import CameraSource, CameraEvent, CameraFrame
 
 
@@ -19,6 +19,10 @@ CAMFETCH_TIMEOUT = 10
 # image size (pixels) that all motion-detection images are scaled to.
 MODETECT_IMAGE_SIZE = 100
 
+# largest tile grid (per side) a camera may use.  The tile mask stores one
+# character per tile in a StringProperty, which holds at most 500 characters.
+MODETECT_MAX_GRID = 22
+
 # alpha factor used in the exponentially weighted moving average.
 # must be between 0.0 and 1.0, with higher values giving faster response.
 MODETECT_EWMA_ALPHA = 0.25
@@ -31,6 +35,30 @@ MODETECT_THRESHOLD = 50
 # to avoid hitting the AppEngine execution limit).
 MODETECT_RUNTIME_LIMIT = 595
 
+# pixel and row stride of the coarse first pass over each frame (1 disables it).
+MODETECT_COARSE_STEP = 4
+
+# the coarse pass decides alone when its rating is more than this many points
+# below (clearly still) or above (clearly moving) MODETECT_THRESHOLD.
+MODETECT_COARSE_MARGIN = 25
+
+# the background model moves 1/2**MODETECT_BACKGROUND_SHIFT of the way towards
+# each new frame (the per-pixel equivalent of MODETECT_EWMA_ALPHA).
+MODETECT_BACKGROUND_SHIFT = 4
+
+# whether the background model also tracks the variance of every sample, so
+# that change within a sample's usual noise is not counted as motion.
+MODETECT_BACKGROUND_VARIANCE = False
+
+# maximum number of bytes of decoded reference frames kept by each process.
+MODETECT_FRAME_CACHE_BYTES = 1024 * 1024
+
+# engine used to compute frame differences (NumPy when available).
+_diff_engine = modetect.get_engine()
+
+# decoded previous frame (or background model) of each camera polled by this process.
+_frame_cache = modetect.FrameCache(MODETECT_FRAME_CACHE_BYTES)
+
 
 # ----------------------------------------------------------------------
 
@@ -91,95 +119,128 @@ class ImageFetcherTask(webapp.RequestHandler):
         return response    
 
         
-    # Low-level helper used to compare two image arrays and return a floating-point
-    # value representing the amount of motion found.  The actual numeric range returned
-    # here is not really important, since the relative change between different values
-    # will be scaled and then compared against the threshold setting.
-    def compareFrames(self, prevImage, curImage):
-        # make sure both arguments are a 4-tuple and the images are the same size.
-        # The 4 elements should be (width,height,pixels,info)
-        if prevImage is None or curImage is None:
-            return 0.1
-        elif len(prevImage) != 4 or len(curImage) != 4:
-            return 0.2
-        elif prevImage[0] != curImage[0] or prevImage[1] != curImage[1]:
-            return 0.3
-
-        # compute the summed total of all pixel changes.
-        diffAmt = 0.0
-        try:
-            curRowIter, prevRowIter = iter(curImage[2]), iter(prevImage[2])
-            while True:
-                curRow, prevRow = curRowIter.next(), prevRowIter.next()
-                try:
-                    curColIter, prevColIter = iter(curRow), iter(prevRow)
-                    while True:
-                        curCol, prevCol = curColIter.next(), prevColIter.next()
-                        diffAmt += abs(curCol - prevCol)
-                except StopIteration:
-                    pass
-        except StopIteration:
-            pass
-
-        # Scale the total into a ranking of image change between 0 and 1,000,000.
-        return 1000000.0 * diffAmt / (curImage[0] * curImage[1] * 3.0)
-
-
-    # Medium-level helper used to make a boolean decision about whether there is 
-    # currently motion found in a newly captured image.
-    def detectMotion(self, cam, imgdata):
-
-        # retrieve the processed version of the last frame.
-        lastimg_mopng = memcache.get("camera{%s}.lastimg_mopng" % cam.key())
-        if lastimg_mopng is not None:
-            lastfloatdata = png.Reader(bytes=lastimg_mopng).asFloat()
-        else:
-            lastfloatdata = None
-
-
-        # Process the new frame for motion detection by adjusting constrast,
-        # resizing to a very small thumbnail, converting to PNG, and then
-        # obtaining raw pixel data from the PNG using pypng.
+    # Low-level helper returning the motion detection settings of a camera.
+    @staticmethod
+    def motionParams(cam):
+        return modetect.MotionParams(threshold=MODETECT_THRESHOLD,
+                                     ewma_alpha=MODETECT_EWMA_ALPHA,
+                                     coarse_step=MODETECT_COARSE_STEP,
+                                     coarse_margin=MODETECT_COARSE_MARGIN,
+                                     background_shift=MODETECT_BACKGROUND_SHIFT,
+                                     background_variance=MODETECT_BACKGROUND_VARIANCE,
+                                     mode=cam.modetect_mode,
+                                     reference=cam.modetect_reference,
+                                     grid=cam.modetect_grid,
+                                     mask=cam.modetect_mask)
+
+
+    # Low-level helper to process a captured image for motion detection by adjusting
+    # constrast, resizing to a very small thumbnail, converting to PNG, and then
+    # obtaining raw integer samples from the PNG using pypng.  Returns the decoded
+    # frame as a 4-tuple (see modetect.decode_png).
+    @staticmethod
+    def motionThumbnail(imgdata):
         img = images.Image(image_data=imgdata)
         img.im_feeling_lucky()
         img.resize(width=MODETECT_IMAGE_SIZE, height=MODETECT_IMAGE_SIZE)
         mopng = img.execute_transforms(output_encoding=images.PNG)
-        memcache.set("camera{%s}.lastimg_mopng" % cam.key(), mopng)
-        floatdata = png.Reader(bytes=mopng).asFloat()
+        return modetect.decode_png(mopng)
+
+
+    # Low-level helper to retrieve the processed version of the last frame.  This
+    # process normally decoded it during the previous poll, so only fetch it from
+    # memcache and decode it again if another worker has stored a newer generation
+    # since (or this process has just started).  `generation` is the current
+    # value of lastimg_gen, which the caller fetches along with its other keys.
+    def loadLastFrame(self, camkey, generation):
+        lastframe = _frame_cache.get(camkey, generation)
+        if lastframe is None:
+            lastimg_moraw = memcache.get("camera{%s}.lastimg_moraw" % camkey)
+            if lastimg_moraw is not None:
+                try:
+                    lastframe = modetect.decode_frame(lastimg_moraw)[0]
+                except ValueError:
+                    lastframe = None
+        return lastframe
+
+
+    # Low-level helper to keep a processed frame for comparison by the next poll.
+    def storeLastFrame(self, camkey, frame):
+        generation = memcache.incr("camera{%s}.lastimg_gen" % camkey, initial_value=0)
+        memcache.set("camera{%s}.lastimg_moraw" % camkey,
+                     modetect.encode_frame(frame, generation or 0))
+        if generation is not None:
+            _frame_cache.put(camkey, generation, frame)
+
+
+    # Low-level helper to retrieve the background model of a camera, using the
+    # copy this process updated during the previous poll when it is still current.
+    # `generation` is the current value of background_gen.
+    def loadBackground(self, camkey, generation):
+        model = _frame_cache.get(camkey + ".background", generation)
+        if model is None:
+            data = memcache.get("camera{%s}.background" % camkey)
+            if data is not None:
+                try:
+                    model = modetect.BackgroundModel.fromstring(data)
+                except ValueError:
+                    model = None
+        return model
 
 
-        # compute the frame difference between lastfloatdata & floatdata
-        motion_amt_change = self.compareFrames(lastfloatdata, floatdata)
+    # Low-level helper to persist an updated background model.
+    def storeBackground(self, camkey, model):
+        generation = memcache.incr("camera{%s}.background_gen" % camkey, initial_value=0)
+        memcache.set("camera{%s}.background" % camkey, model.tostring())
+        if generation is not None:
+            _frame_cache.put(camkey + ".background", generation, model, model.nbytes())
 
 
-        # compute an exponentially-weighted moving average (EWMA).
-        ewma = memcache.get("camera{%s}.ewma" % cam.key())
-        if ewma is not None:
-            ewma = MODETECT_EWMA_ALPHA * motion_amt_change + (1.0 - MODETECT_EWMA_ALPHA) * ewma
+    # Medium-level helper used to make a boolean decision about whether there is 
+    # currently motion found in a newly captured image.
+    # Returns (motion_rating, motion_found, tile_ratings), where tile_ratings has
+    # the rating of each tile of the camera's detection grid (None when masked).
+    def detectMotion(self, cam, imgdata):
+        camkey = str(cam.key())
+        params = self.motionParams(cam)
+
+        # The thumbnail PNG is only decoded this once.  In luma mode the frame is
+        # reduced to one brightness plane right away, so everything after this (the
+        # stored reference, the frame difference and the tiles) handles a third of
+        # the data.
+        frame = modetect.prepare_frame(self.motionThumbnail(imgdata), params)
+
+        # restore what the pipeline remembers about this camera: the EWMAs and
+        # either its background model or its previous frame.  The EWMAs and the
+        # generation of the reference come back in a single memcache round trip.
+        if params.reference == "background":
+            genkey = "background_gen"
         else:
-            ewma = motion_amt_change
-        memcache.set("camera{%s}.ewma" % cam.key(), ewma)
-
-
-        # use the EWMA to compute a score of the motion.
-        if ewma != 0 and motion_amt_change != 0:
-            motion_rating = abs(100.0 * (motion_amt_change - ewma) / ewma)
+            genkey = "lastimg_gen"
+        cached = memcache.get_multi(["ewma", "tile_ewma", genkey],
+                                    key_prefix="camera{%s}." % camkey)
+        state = modetect.MotionState()
+        state.ewma = cached.get("ewma")
+        state.tile_ewmas = cached.get("tile_ewma")
+        if params.reference == "background":
+            state.background = self.loadBackground(camkey, cached.get(genkey))
         else:
-            motion_rating = 0
+            state.lastframe = self.loadLastFrame(camkey, cached.get(genkey))
 
-        self.response.out.write("amt_change = %f, ewma = %f, motion_rating = %f\n" % (motion_amt_change, ewma, motion_rating))
+        result = modetect.detect_motion(frame, state, params, _diff_engine)
 
-        # clamp the maximum range, and ensure it is an integer.
-        if motion_rating > 100.0:
-            motion_rating = 100
+        memcache.set_multi({"ewma": state.ewma, "tile_ewma": state.tile_ewmas},
+                           key_prefix="camera{%s}." % camkey)
+        memcache.incr("camera{%s}.stage_%s" % (camkey, result.stage), initial_value=0)
+        if params.reference == "background":
+            self.storeBackground(camkey, state.background)
         else:
-            motion_rating = int(round(motion_rating))
+            self.storeLastFrame(camkey, frame)
 
-        # make a boolean decision about whether there is motion or not.
-        # TODO: this should use a user-controlled setting in the CameraSource
-        motion_found = (motion_rating > MODETECT_THRESHOLD)
+        self.response.out.write("stage = %s, amt_change = %f, ewma = %f, motion_rating = %d, tile_ratings = %r\n" %
+                                (result.stage, result.amount, state.ewma, result.rating, result.tile_ratings))
 
-        return (motion_rating, motion_found)
+        return (result.rating, result.found, result.tile_ratings)
 
 
     # Main worker of camera capturing and detection logic.
@@ -200,7 +261,7 @@ class ImageFetcherTask(webapp.RequestHandler):
         memcache.set("camera{%s}.lastimg_time" % cam.key(), capture_time)
 
         # decide whether there is motion found.
-        (motion_rating, motion_found) = self.detectMotion(cam, response.content)
+        (motion_rating, motion_found, tile_ratings) = self.detectMotion(cam, response.content)
         
         # add to an existing event if needed
         eventkey = memcache.get("camera{%s}.eventkey" % cam.key())
@@ -421,6 +482,10 @@ class EditCameraSourceHandler(webapp.RequestHandler):
             self.response.out.write(' "poll_max_fps": %d,' % cam.poll_max_fps)
             self.response.out.write(' "alert_max_fps": %d,' % cam.alert_max_fps)
             self.response.out.write(' "num_secs_after": %f,' % cam.num_secs_after)
+            self.response.out.write(' "modetect_mode": "%s",' % cam.modetect_mode)
+            self.response.out.write(' "modetect_reference": "%s",' % cam.modetect_reference)
+            self.response.out.write(' "modetect_grid": %d,' % cam.modetect_grid)
+            self.response.out.write(' "modetect_mask": "%s",' % (cam.modetect_mask or ""))
             
             if cam.authuser:
                 tmpuser = cam.authuser
@@ -443,6 +508,32 @@ class EditCameraSourceHandler(webapp.RequestHandler):
             cam.poll_max_fps = int(self.request.get('poll_max_fps'))
             cam.alert_max_fps = int(self.request.get('alert_max_fps'))
             cam.num_secs_after = float(self.request.get('num_secs_after'))
+
+            # motion detection settings are optional in the request.
+            if self.request.get('modetect_mode'):
+                cam.modetect_mode = self.request.get('modetect_mode')
+            if self.request.get('modetect_reference'):
+                cam.modetect_reference = self.request.get('modetect_reference')
+            if self.request.get('modetect_grid'):
+                # detect_motion falls back to a single tile for a grid it
+                # cannot use, which would silently ignore the mask.
+                try:
+                    tmpgrid = int(self.request.get('modetect_grid'))
+                except ValueError:
+                    tmpgrid = 0
+                if not 1 <= tmpgrid <= MODETECT_MAX_GRID:
+                    self.error(400)
+                    self.response.out.write("invalid modetect_grid")
+                    return
+                cam.modetect_grid = tmpgrid
+                tmpmask = self.request.get('modetect_mask')
+                try:
+                    modetect.parse_mask(tmpmask, cam.modetect_grid ** 2)
+                except ValueError:
+                    self.error(400)
+                    self.response.out.write("invalid modetect_mask")
+                    return
+                cam.modetect_mask = tmpmask or None
             
             tmpuser = self.request.get('authuser')
             if not tmpuser:
@@ -620,6 +711,15 @@ class MainSummaryHandler(webapp.RequestHandler):
                     td = (datetime.now() - lastimg_time)
                     cam.status_text = "Enabled, polled %s ago" % td
 
+                # Report how often the coarse detection pass settled a frame alone.
+                stages = memcache.get_multi(["still", "moving", "full"],
+                                            key_prefix="camera{%s}.stage_" % cam.key())
+                total = sum(stages.values())
+                if total:
+                    cam.status_text += " (coarse pass decided %d%%: %d still, %d moving, %d full)" % \
+                        (100 * (total - stages.get("full", 0)) // total,
+                         stages.get("still", 0), stages.get("moving", 0), stages.get("full", 0))
+
 
             # TODO: deleted frames should not be included in these counts.
             qf = CameraFrame.all(keys_only=True)
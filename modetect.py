@@ -0,0 +1,1113 @@
+#!/usr/bin/env python
+
+# Motion-detection primitives used by the ImageFetcherTask handler.
+#
+# Nothing in this module depends on the AppEngine APIs, so the same code
+# can be exercised from the command line (tests, tuning and benchmarks)
+# as from inside a request handler.
+
+from array import array
+import operator, struct, sys, png
+from itertools import izip
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# ----------------------------------------------------------------------
+
+# Convert a sequence of boxed rows (as returned by png.Reader) into a single
+# flat contiguous buffer of samples.  Rows are copied one at a time as they are
+# produced, so this also works for rows decoded into reused buffers.
+def flatten(rows, typecode='B'):
+    samples = array(typecode)
+    for row in rows:
+        samples.extend(row)
+    return samples
+
+
+# Decode a PNG image into a frame 4-tuple of (width,height,samples,info), where
+# samples is a flat buffer of integer samples straight from the PNG (8-bit for
+# the images served by the AppEngine images service).  No floating point
+# conversion is done; scale_rating applies the normalisation once instead.
+# Each row is copied straight into the frame, so the rows are decoded into
+# reused buffers rather than a fresh array each.
+def decode_png(pngdata):
+    width, height, pixels, info = png.Reader(bytes=pngdata).asDirect(reuse_rows=True)
+    samples = flatten(pixels, 'BH'[info['bitdepth'] > 8])
+    return (width, height, samples, info)
+
+
+# Raw frame format used to keep motion thumbnails in memcache without a PNG
+# round trip: a fixed header of magic, width, height, planes, bitdepth and
+# generation, followed by the flat samples (16-bit samples in network order).
+RAW_MAGIC = 'MF'
+RAW_HEADER_FORMAT = '!2sHHBBI'
+RAW_HEADER_SIZE = struct.calcsize(RAW_HEADER_FORMAT)
+
+# Encode a frame 4-tuple into the raw frame format.
+def encode_frame(frame, generation=0):
+    width, height, samples, info = frame
+    if info['bitdepth'] > 8:
+        samples = array('H', samples)
+        if sys.byteorder == 'little':
+            samples.byteswap()
+    elif not isinstance(samples, array):
+        samples = array('B', samples)
+    header = struct.pack(RAW_HEADER_FORMAT, RAW_MAGIC, width, height,
+                         info['planes'], info['bitdepth'], generation)
+    return header + samples.tostring()
+
+
+# Decode the raw frame format, returning a (frame, generation) pair.
+def decode_frame(data):
+    if len(data) < RAW_HEADER_SIZE:
+        raise ValueError("raw frame is too short for its header")
+    magic, width, height, planes, bitdepth, generation = \
+        struct.unpack(RAW_HEADER_FORMAT, data[:RAW_HEADER_SIZE])
+    if magic != RAW_MAGIC:
+        raise ValueError("raw frame has invalid magic %r" % magic)
+    samples = array('BH'[bitdepth > 8], data[RAW_HEADER_SIZE:])
+    if bitdepth > 8 and sys.byteorder == 'little':
+        samples.byteswap()
+    if len(samples) != width * height * planes:
+        raise ValueError("raw frame has %d samples, expected %d" %
+                         (len(samples), width * height * planes))
+    info = dict(size=(width, height), planes=planes, bitdepth=bitdepth)
+    return (width, height, samples, info), generation
+
+
+# The weighted red, green and blue terms of luma for every 8-bit sample; the
+# rounding constant is folded into the blue table.
+LUMA_TABLES = ([77 * x for x in range(256)], [150 * x for x in range(256)],
+               [29 * x + 128 for x in range(256)])
+
+
+# Convert a frame to a single plane of 8-bit luma, using the integer BT.601
+# weights Y = (77*R + 150*G + 29*B + 128) >> 8.  Greyscale frames keep their
+# grey plane; any alpha plane is dropped.  With the numpy engine the whole
+# frame is converted in one expression; otherwise each pixel costs three table
+# lookups.
+def to_luma(frame, engine=None):
+    width, height, samples, info = frame
+    planes, bitdepth = info['planes'], info['bitdepth']
+    if engine is None:
+        engine = get_engine()
+    if engine.name == 'numpy':
+        v = numpy_view(samples).reshape(-1, planes).astype(numpy.int32)
+        if bitdepth > 8:
+            v >>= bitdepth - 8
+        elif bitdepth < 8:
+            v *= 255 // (2**bitdepth - 1)
+        if planes < 3:
+            y = v[:, 0]
+        else:
+            y = (77 * v[:, 0] + 150 * v[:, 1] + 29 * v[:, 2] + 128) >> 8
+        luma = array('B', y.astype(numpy.uint8).tostring())
+    else:
+        if bitdepth > 8:
+            samples = map((bitdepth - 8).__rrshift__, samples)
+        elif bitdepth < 8:
+            samples = map((255 // (2**bitdepth - 1)).__mul__, samples)
+        if planes < 3:
+            luma = array('B', samples[0::planes])
+        else:
+            rt, gt, bt = LUMA_TABLES
+            luma = array('B', [(rt[r] + gt[g] + bt[b]) >> 8 for r, g, b in
+                               izip(samples[0::planes], samples[1::planes],
+                                    samples[2::planes])])
+    info = dict(size=(width, height), planes=1, bitdepth=8,
+                greyscale=True, alpha=False)
+    return (width, height, luma, info)
+
+
+# Return the value of a fully saturated sample described by a frame's info.
+def frame_maxval(info):
+    return 2**info['bitdepth'] - 1
+
+
+# Scale a summed frame difference into a rating between 0 and 1,000,000.
+# `maxval` is the value of a fully saturated sample in the buffers that
+# were compared, so that integer and floating-point samples rate the same.
+def scale_rating(diffAmt, width, height, planes=3, maxval=1.0):
+    return 1000000.0 * diffAmt / (maxval * width * height * planes)
+
+
+# ----------------------------------------------------------------------
+
+# Pure Python difference engine.  Buffers may be arrays, lists or strings
+# of raw 8-bit samples.  The per-sample work is done by builtins mapped
+# over the whole buffer, rather than by an interpreted loop.
+class DiffEngine:
+    name = 'python'
+
+    def samples(self, buf):
+        if isinstance(buf, str):
+            return array('B', buf)
+        return buf
+
+    # Return the sum of absolute differences between two sample buffers.
+    def sad(self, prev, cur):
+        prev, cur = self.samples(prev), self.samples(cur)
+        if len(prev) != len(cur):
+            raise ValueError("sample buffers differ in length (%d != %d)" %
+                             (len(prev), len(cur)))
+        return sum(map(abs, map(operator.sub, cur, prev)))
+
+    # Return the sum of absolute differences for each (prev, cur) pair.
+    def sad_batch(self, pairs):
+        return [self.sad(prev, cur) for prev, cur in pairs]
+
+
+# array typecodes that mean the same C type to numpy.
+NUMPY_TYPECODES = 'bBhHiIlLfd'
+
+
+# A numpy array sharing the memory of a sample buffer (an array with one of
+# NUMPY_TYPECODES, or a string of bytes).  Writing to it changes the buffer.
+def numpy_view(buf):
+    if isinstance(buf, str):
+        return numpy.frombuffer(buf, numpy.uint8)
+    if isinstance(buf, array) and buf.typecode in NUMPY_TYPECODES:
+        return numpy.frombuffer(buf, buf.typecode)
+    return numpy.asarray(buf)
+
+
+# NumPy-backed difference engine, only available when numpy is importable.
+class NumpyDiffEngine(DiffEngine):
+    name = 'numpy'
+
+    def samples(self, buf):
+        return numpy_view(buf)
+
+    def widen(self, a):
+        if a.dtype.kind == 'f':
+            return a.astype(numpy.float64)
+        return a.astype(numpy.int64)
+
+    def sad(self, prev, cur):
+        prev, cur = self.samples(prev), self.samples(cur)
+        if prev.shape != cur.shape:
+            raise ValueError("sample buffers differ in length (%d != %d)" %
+                             (len(prev), len(cur)))
+        total = numpy.abs(self.widen(cur) - self.widen(prev)).sum()
+        if total.dtype.kind == 'f':
+            return float(total)
+        return int(total)
+
+    def sad_batch(self, pairs):
+        pairs = [(self.samples(prev), self.samples(cur)) for prev, cur in pairs]
+        if not pairs:
+            return []
+        if len(set([p.shape for pair in pairs for p in pair])) != 1:
+            # Ragged batches cannot be stacked, so score each pair alone.
+            return [self.sad(prev, cur) for prev, cur in pairs]
+        prev = self.widen(numpy.vstack([p for p, c in pairs]))
+        cur = self.widen(numpy.vstack([c for p, c in pairs]))
+        totals = numpy.abs(cur - prev).sum(axis=1)
+        if totals.dtype.kind == 'f':
+            return map(float, totals)
+        return map(int, totals)
+
+
+_engines = {'python': DiffEngine}
+if numpy is not None:
+    _engines['numpy'] = NumpyDiffEngine
+
+
+# Return a difference engine by name.  When no name is given the fastest
+# available engine is chosen.
+def get_engine(name=None):
+    if name is None:
+        name = ('python', 'numpy')[numpy is not None]
+    try:
+        return _engines[name]()
+    except KeyError:
+        raise ValueError("unknown or unavailable difference engine %r" % name)
+
+
+# Score many (prev, cur) frame pairs of the same geometry in one call,
+# returning the scaled rating of each pair.
+def rate_batch(pairs, width, height, planes=3, maxval=1.0, engine=None):
+    if engine is None:
+        engine = get_engine()
+    return [scale_rating(diffAmt, width, height, planes, maxval)
+            for diffAmt in engine.sad_batch(pairs)]
+
+
+# Return the samples of every `step`th pixel on every `step`th row of a flat
+# sample buffer, as a coarse stand-in for the whole frame.  The samples of a
+# pixel are kept together, so the result is itself a (smaller) frame.
+def subsample(samples, width, height, planes, step):
+    if isinstance(samples, array):
+        out = array(samples.typecode)
+    else:
+        out = array('B')
+    rowlen = width * planes
+    pixels = out[:]
+    pixels.extend([0] * (len(range(0, width, step)) * planes))
+    for y in range(0, height, step):
+        row = samples[y*rowlen:(y+1)*rowlen]
+        for k in range(planes):
+            pixels[k::planes] = array(out.typecode, row[k::step*planes])
+        out.extend(pixels)
+    return out
+
+
+# ----------------------------------------------------------------------
+
+# Splits a frame into a grid of `cols` x `rows` tiles and measures the change
+# in each tile.  The per-pixel absolute differences are accumulated into a
+# summed-area table, so that the difference total of any tile (or any other
+# rectangle) is found with four lookups.  Tiles switched off in `mask` (a
+# sequence of one boolean per tile, in row-major order) are never compared.
+class TileGrid:
+    def __init__(self, width, height, cols=1, rows=1, mask=None):
+        if cols < 1 or rows < 1 or cols > width or rows > height:
+            raise ValueError("cannot split %dx%d frame into %dx%d tiles" %
+                             (width, height, cols, rows))
+        self.width, self.height = width, height
+        self.cols, self.rows = cols, rows
+        xs = [width * i // cols for i in range(cols + 1)]
+        ys = [height * j // rows for j in range(rows + 1)]
+        self.tiles = [(xs[i], ys[j], xs[i+1], ys[j+1])
+                      for j in range(rows) for i in range(cols)]
+        if mask is None:
+            mask = [True] * len(self.tiles)
+        if len(mask) != len(self.tiles):
+            raise ValueError("mask has %d entries for %d tiles" %
+                             (len(mask), len(self.tiles)))
+        self.mask = map(bool, mask)
+
+        # For each band of tiles, the column spans covered by included tiles
+        # (adjacent included tiles are merged into a single span).
+        self.bands = []
+        for j in range(rows):
+            spans = []
+            for i in range(cols):
+                if not self.mask[j * cols + i]:
+                    continue
+                if spans and spans[-1][1] == xs[i]:
+                    spans[-1] = (spans[-1][0], xs[i+1])
+                else:
+                    spans.append((xs[i], xs[i+1]))
+            self.bands.append((ys[j], ys[j+1], spans))
+        self._pixel_mask = None
+
+    # True when the grid is a single unmasked tile covering the whole frame.
+    def trivial(self):
+        return len(self.tiles) == 1 and self.mask[0]
+
+    # Number of pixels of the frame covered by included tiles.
+    def included_area(self):
+        return sum([(x1 - x0) * (y1 - y0)
+                    for (x0, y0, x1, y1), on in zip(self.tiles, self.mask) if on])
+
+    # Return a grid of the same tiles and mask over a frame of another size,
+    # such as a subsampled copy of the frame.
+    def scaled(self, width, height):
+        return TileGrid(width, height, self.cols, self.rows, self.mask)
+
+    # Boolean numpy array of shape (height, width), true for the pixels of
+    # included tiles.  Built on first use and kept with the grid.
+    def pixel_mask(self):
+        if self._pixel_mask is None:
+            m = numpy.zeros((self.height, self.width), bool)
+            for y0, y1, spans in self.bands:
+                for x0, x1 in spans:
+                    m[y0:y1, x0:x1] = True
+            self._pixel_mask = m
+        return self._pixel_mask
+
+    # Build the summed-area table of the per-pixel absolute differences
+    # (summed over all planes) between two flat sample buffers.  The table
+    # has (width+1)*(height+1) entries; pixels of masked tiles count as 0.
+    # With the numpy engine the table is built by whole-array operations.
+    def integral(self, prev, cur, planes, engine=None):
+        if engine is not None and engine.name == 'numpy':
+            return self.integral_numpy(prev, cur, planes, engine)
+        width = self.width
+        stride = width + 1
+        sat = array('d', [0.0]) * (stride * (self.height + 1))
+        rowcum = [0] * stride
+        for y0, y1, spans in self.bands:
+            for y in range(y0, y1):
+                run, filled = 0, 0
+                for x0, x1 in spans:
+                    # Masked columns leave the running total unchanged.
+                    rowcum[filled+1:x0+1] = [run] * (x0 - filled)
+                    start = (y * width + x0) * planes
+                    end = (y * width + x1) * planes
+                    d = map(abs, map(operator.sub, cur[start:end], prev[start:end]))
+                    pixels = d[0::planes]
+                    for k in range(1, planes):
+                        pixels = map(operator.add, pixels, d[k::planes])
+                    x = x0
+                    for v in pixels:
+                        run += v
+                        x += 1
+                        rowcum[x] = run
+                    filled = x1
+                rowcum[filled+1:stride] = [run] * (width - filled)
+                base = (y + 1) * stride
+                sat[base:base+stride] = array('d',
+                    map(operator.add, sat[base-stride:base], rowcum))
+        return sat
+
+    def integral_numpy(self, prev, cur, planes, engine):
+        prev, cur = engine.samples(prev), engine.samples(cur)
+        d = numpy.abs(engine.widen(cur) - engine.widen(prev))
+        d = d.reshape(self.height, self.width, planes).sum(2)
+        d[~self.pixel_mask()] = 0
+        sat = numpy.zeros((self.height + 1, self.width + 1), numpy.float64)
+        sat[1:, 1:] = d.cumsum(0).cumsum(1)
+        return array('d', sat.tostring())
+
+    # Return the sum of the summed-area table over the rectangle from
+    # (x0,y0) inclusive to (x1,y1) exclusive.
+    def region_sum(self, sat, x0, y0, x1, y1):
+        stride = self.width + 1
+        return (sat[y1*stride + x1] - sat[y0*stride + x1]
+                - sat[y1*stride + x0] + sat[y0*stride + x0])
+
+    # Return the difference total of every tile, or None for masked tiles.
+    def tile_sums(self, sat):
+        sums = []
+        for tile, on in zip(self.tiles, self.mask):
+            if on:
+                sums.append(self.region_sum(sat, *tile))
+            else:
+                sums.append(None)
+        return sums
+
+
+# Parse a tile mask stored on a CameraSource: a string of '1' (include) and
+# '0' (exclude) characters, one per tile in row-major order.  An empty mask
+# includes every tile.
+def parse_mask(maskstr, ntiles):
+    if not maskstr:
+        return None
+    if len(maskstr) != ntiles or maskstr.strip('01'):
+        raise ValueError("tile mask must be %d characters of '0' or '1'" % ntiles)
+    return [c == '1' for c in maskstr]
+
+
+# ----------------------------------------------------------------------
+
+# Fold a new motion amount into an exponentially-weighted moving average.
+# `ewma` is None when there is no history yet.
+def update_ewma(ewma, amount, alpha):
+    if ewma is None:
+        return amount
+    return alpha * amount + (1.0 - alpha) * ewma
+
+
+# Score a motion amount against its EWMA, as an integer between 0 and 100.
+def motion_rating(amount, ewma):
+    if ewma and amount:
+        rating = abs(100.0 * (amount - ewma) / ewma)
+    else:
+        rating = 0
+    return int(round(min(rating, 100.0)))
+
+
+# ----------------------------------------------------------------------
+
+# Per-pixel background model: an exponentially-weighted running mean of every
+# sample (and optionally its variance), against which new frames are scored
+# instead of against the single previous frame.  The mean is kept in fixed
+# point with FRAC fractional bits, and alpha is 2**-shift.  The model's arrays
+# are allocated once and keep their identity, but update() works a whole array
+# at a time (with numpy when it is available and use_numpy is set), building
+# full-size temporaries every frame before copying the results back.  With the
+# variance tracked, change within DEVIATIONS standard deviations of a sample's
+# mean is taken as that sample's usual noise and does not count as motion.
+class BackgroundModel:
+    FRAC = 8
+    DEVIATIONS = 2.5
+    use_numpy = True
+    MAGIC = 'BG'
+    HEADER_FORMAT = '!2sHHBBBBI'
+
+    def __init__(self, width, height, planes, bitdepth=8, shift=4, variance=False):
+        n = width * height * planes
+        self.width, self.height = width, height
+        self.planes, self.bitdepth = planes, bitdepth
+        self.shift = shift
+        self.frames = 0
+        # signed, so that its items are plain ints rather than longs; the
+        # mean never exceeds 2**(bitdepth+FRAC).
+        self.mean = array('i', [0]) * n
+        # the mean rounded back to whole samples, used as the reference frame.
+        self.samples = array('BH'[bitdepth > 8], [0]) * n
+        if variance:
+            self.variance = array('I', [0]) * n
+        else:
+            self.variance = None
+
+    # True when a frame has the geometry this model was built for.
+    def matches(self, frame):
+        width, height, samples, info = frame
+        return ((width, height, info['planes'], info['bitdepth']) ==
+                (self.width, self.height, self.planes, self.bitdepth))
+
+    def nbytes(self):
+        total = len(self.mean) * self.mean.itemsize
+        total += len(self.samples) * self.samples.itemsize
+        if self.variance is not None:
+            total += len(self.variance) * self.variance.itemsize
+        return total
+
+    # Return the background as a frame 4-tuple to score the new `samples`
+    # against.  Without the variance (or without `samples`) this shares the
+    # model's samples.  With it, every new sample is pulled to within
+    # DEVIATIONS standard deviations of its mean instead, so the difference
+    # of each sample is only the part beyond its usual noise.
+    def reference(self, samples=None):
+        info = dict(size=(self.width, self.height), planes=self.planes,
+                    bitdepth=self.bitdepth)
+        if self.variance is None or samples is None:
+            return (self.width, self.height, self.samples, info)
+        k, typecode = self.DEVIATIONS, self.samples.typecode
+        if self.use_numpy and numpy is not None:
+            band = (k * numpy.sqrt(numpy_view(self.variance))).astype(numpy.int64)
+            mean = numpy_view(self.samples).astype(numpy.int64)
+            ref = array(typecode, self.samples)
+            numpy_view(ref)[:] = numpy.clip(numpy_view(samples), mean - band,
+                                            mean + band)
+        else:
+            band = [int(k * v ** 0.5) for v in self.variance]
+            ref = array(typecode, [min(max(x, m - b), m + b) for x, m, b
+                                   in izip(samples, self.samples, band)])
+        return (self.width, self.height, ref, info)
+
+    # Fold the samples of a new frame into the model.
+    def update(self, samples):
+        if self.use_numpy and numpy is not None:
+            self.update_numpy(samples)
+        else:
+            self.update_python(samples)
+        self.frames += 1
+
+    # update() through list comprehensions over the whole arrays, which is
+    # quicker than indexing the arrays sample by sample.
+    def update_python(self, samples):
+        mean, var = self.mean, self.variance
+        frac, shift = self.FRAC, self.shift
+        if self.frames == 0:
+            # The first frame is the background.
+            mean[:] = array(mean.typecode, [x << frac for x in samples])
+            self.samples[:] = array(self.samples.typecode, samples)
+            return
+        if var is None:
+            m = [mm + (((x << frac) - mm) >> shift) for x, mm in izip(samples, mean)]
+        else:
+            d = [(x << frac) - mm for x, mm in izip(samples, mean)]
+            m = [mm + (dd >> shift) for dd, mm in izip(d, mean)]
+            var[:] = array(var.typecode, [v + ((((dd * dd) >> (2 * frac)) - v) >> shift)
+                                          for dd, v in izip(d, var)])
+        mean[:] = array(mean.typecode, m)
+        self.round_mean(m)
+
+    # update() with numpy, through views of the arrays.
+    def update_numpy(self, samples):
+        frac, shift = self.FRAC, self.shift
+        x = numpy_view(samples).astype(numpy.int64) << frac
+        mean = numpy_view(self.mean)
+        if self.frames == 0:
+            # The first frame is the background.
+            mean[:] = x
+            numpy_view(self.samples)[:] = numpy_view(samples)
+            return
+        m = mean.astype(numpy.int64)
+        d = x - m
+        m += d >> shift
+        mean[:] = m
+        numpy_view(self.samples)[:] = (m + (1 << (frac - 1))) >> frac
+        if self.variance is not None:
+            var = numpy_view(self.variance)
+            v = var.astype(numpy.int64)
+            var[:] = v + ((((d * d) >> (2 * frac)) - v) >> shift)
+
+    # Set the reference samples to the mean (or to `m`, a list of its
+    # values), rounded back to whole samples.
+    def round_mean(self, m=None):
+        frac = self.FRAC
+        half = 1 << (frac - 1)
+        if self.use_numpy and numpy is not None:
+            rounded = (numpy_view(self.mean).astype(numpy.int64) + half) >> frac
+            numpy_view(self.samples)[:] = rounded
+            return
+        if m is None:
+            m = self.mean
+        self.samples[:] = array(self.samples.typecode, [(mm + half) >> frac for mm in m])
+
+    # Serialise the model into a compact binary string (network byte order).
+    def tostring(self):
+        header = struct.pack(self.HEADER_FORMAT, self.MAGIC, self.width, self.height,
+                             self.planes, self.bitdepth, self.shift,
+                             self.variance is not None, self.frames)
+        parts = [header]
+        for a in (self.mean, self.variance):
+            if a is None:
+                continue
+            # Swap in place and back again rather than copying the array.
+            if sys.byteorder == 'little':
+                a.byteswap()
+            parts.append(a.tostring())
+            if sys.byteorder == 'little':
+                a.byteswap()
+        return ''.join(parts)
+
+    # Rebuild a model from the string made by tostring().
+    def fromstring(cls, data):
+        size = struct.calcsize(cls.HEADER_FORMAT)
+        if len(data) < size:
+            raise ValueError("background model is too short for its header")
+        magic, width, height, planes, bitdepth, shift, variance, frames = \
+            struct.unpack(cls.HEADER_FORMAT, data[:size])
+        if magic != cls.MAGIC:
+            raise ValueError("background model has invalid magic %r" % magic)
+        model = cls(width, height, planes, bitdepth, shift, variance)
+        arrays = [model.mean]
+        if variance:
+            arrays.append(model.variance)
+        n = len(model.mean)
+        for a in arrays:
+            chunk = data[size:size + n * a.itemsize]
+            if len(chunk) != n * a.itemsize:
+                raise ValueError("background model is truncated")
+            loaded = array(a.typecode, chunk)
+            if sys.byteorder == 'little':
+                loaded.byteswap()
+            a[:] = loaded
+            size += n * a.itemsize
+        model.round_mean()
+        model.frames = frames
+        return model
+    fromstring = classmethod(fromstring)
+
+
+# ----------------------------------------------------------------------
+
+# Compare two frame 4-tuples and return a floating-point value representing
+# the amount of motion found, together with a list of the amount for each tile
+# of `grid` (None for masked tiles, or instead of the list when the frames could
+# not be compared).  With a `step` above 1, the comparison only looks at every
+# step'th pixel of every step'th row, tiles included.
+def compare_frames(prevImage, curImage, grid=None, step=1, engine=None):
+    # make sure both arguments are a 4-tuple and the images are the same size.
+    # The 4 elements should be (width,height,samples,info), where samples is a
+    # flat buffer of integer samples as returned by decode_png.
+    if prevImage is None or curImage is None:
+        return 0.1, None
+    elif len(prevImage) != 4 or len(curImage) != 4:
+        return 0.2, None
+    elif prevImage[0] != curImage[0] or prevImage[1] != curImage[1]:
+        return 0.3, None
+    elif len(prevImage[2]) != len(curImage[2]):
+        return 0.4, None
+
+    width, height, info = curImage[0], curImage[1], curImage[3]
+    planes, maxval = info['planes'], frame_maxval(info)
+
+    # compute the summed total of all pixel changes, in integer sample units.
+    # Tiled comparisons go through a summed-area table; a single whole-frame
+    # tile only needs the bulk difference engine.  With step > 1 only every
+    # step'th pixel of every step'th row is compared.
+    if engine is None:
+        engine = get_engine()
+    prevSamples, curSamples = prevImage[2], curImage[2]
+    if step > 1:
+        if grid is not None and not grid.trivial():
+            try:
+                grid = grid.scaled(len(range(0, width, step)),
+                                   len(range(0, height, step)))
+            except ValueError:
+                # too few pixels left to cover every tile.
+                return 0.5, None
+        prevSamples = subsample(prevSamples, width, height, planes, step)
+        curSamples = subsample(curSamples, width, height, planes, step)
+    if grid is None or grid.trivial():
+        area = len(curSamples) // planes
+        diffAmt = engine.sad(prevSamples, curSamples)
+        tileAmts = [scale_rating(diffAmt, area, 1, planes, maxval)]
+    else:
+        tileSums = grid.tile_sums(grid.integral(prevSamples, curSamples,
+                                                planes, engine))
+        tileAmts = []
+        for (x0, y0, x1, y1), tileSum in zip(grid.tiles, tileSums):
+            if tileSum is None:
+                tileAmts.append(None)
+            else:
+                tileAmts.append(scale_rating(tileSum, x1 - x0, y1 - y0, planes, maxval))
+        diffAmt = sum([tileSum for tileSum in tileSums if tileSum is not None])
+        area = grid.included_area()
+
+    # Scale the total into a ranking of image change between 0 and 1,000,000.
+    if area == 0:
+        return 0.0, tileAmts
+    return scale_rating(diffAmt, area, 1, planes, maxval), tileAmts
+
+
+# Tunable settings of the detection pipeline.  The defaults are placeholders;
+# the request handlers fill them in from their MODETECT_* settings and the
+# CameraSource, while tools may vary them freely.
+class MotionParams:
+    defaults = dict(threshold=50, ewma_alpha=0.25,
+                    coarse_step=4, coarse_margin=25,
+                    background_shift=4, background_variance=False,
+                    mode="rgb", reference="frame", grid=1, mask=None)
+
+    def __init__(self, **kw):
+        for name in kw:
+            if name not in self.defaults:
+                raise ValueError("unknown motion parameter %r" % name)
+        for name, value in self.defaults.items():
+            setattr(self, name, kw.get(name, value))
+
+    def __repr__(self):
+        return "MotionParams(%s)" % ", ".join(["%s=%r" % (name, getattr(self, name))
+                                               for name in sorted(self.defaults)])
+
+
+# Convert a motion parameter given as a string (on a command line, say) to the
+# type of its default.  Parameters whose default is a string or None (mode,
+# reference, mask) are kept as strings: a mask of "0110" is not a number.
+def parse_param(name, value):
+    if name not in MotionParams.defaults:
+        raise ValueError("unknown motion parameter %r" % name)
+    default = MotionParams.defaults[name]
+    if isinstance(default, bool):
+        if value.lower() not in ("true", "false"):
+            raise ValueError("motion parameter %s must be true or false, not %r" %
+                             (name, value))
+        return value.lower() == "true"
+    for kind in (int, float):
+        if isinstance(default, kind):
+            try:
+                return kind(value)
+            except ValueError:
+                raise ValueError("motion parameter %s must be %s, not %r" %
+                                 (name, kind.__name__, value))
+    return value
+
+
+# Everything the pipeline remembers about a camera from one frame to the next.
+class MotionState:
+    def __init__(self):
+        self.ewma = None
+        self.tile_ewmas = None
+        self.lastframe = None
+        self.background = None
+
+
+# Result of running one frame through detect_motion.
+class MotionResult:
+    def __init__(self, rating, found, tile_ratings, stage, amount):
+        self.rating = rating
+        self.found = found
+        self.tile_ratings = tile_ratings
+        self.stage = stage
+        self.amount = amount
+
+
+# Convert a decoded motion thumbnail into the frame the pipeline works on.
+# Luma mode stores and compares a third of the data of RGB mode; with numpy it
+# is also the faster mode, but in pure Python the conversion of every pixel
+# costs more than the RGB coarse pass saves (see the detect_luma bench stage).
+def prepare_frame(frame, params, engine=None):
+    if params.mode == "luma":
+        return to_luma(frame, engine)
+    return frame
+
+
+# Run a prepared frame through the motion detection pipeline, updating `state`
+# in place, and return a MotionResult.
+def detect_motion(frame, state, params, engine=None):
+    # find the reference to compare against: either the running background
+    # model of the camera, or the previous frame (which this frame replaces).
+    if params.reference == "background":
+        if state.background is None or not state.background.matches(frame):
+            info = frame[3]
+            state.background = BackgroundModel(frame[0], frame[1], info['planes'],
+                                               info['bitdepth'], params.background_shift,
+                                               params.background_variance)
+        if state.background.frames:
+            lastframe = state.background.reference(frame[2])
+        else:
+            lastframe = None
+    else:
+        lastframe = state.lastframe
+        state.lastframe = frame
+
+    # split the frame into the camera's grid of tiles, skipping masked tiles.
+    try:
+        grid = TileGrid(frame[0], frame[1], params.grid, params.grid,
+                        parse_mask(params.mask, params.grid ** 2))
+    except ValueError:
+        grid = TileGrid(frame[0], frame[1])
+
+    # compute the frame difference between lastframe & frame.  First try a
+    # coarse pass over a subsample of the pixels, and only fall back to the
+    # full frame when the coarse rating is too close to the threshold to call.  A tiled camera's coarse pass also gives coarse tile amounts, which
+    # stand in for the full ones when the whole-frame rating is clear.
+    stage = "full"
+    if state.ewma and params.coarse_step > 1:
+        coarse_amt, coarse_tiles = compare_frames(lastframe, frame, grid,
+                                                  params.coarse_step, engine)
+        if coarse_tiles is not None:
+            coarse_rating = motion_rating(coarse_amt,
+                update_ewma(state.ewma, coarse_amt, params.ewma_alpha))
+            if coarse_rating < params.threshold - params.coarse_margin:
+                stage = "still"
+            elif coarse_rating > params.threshold + params.coarse_margin:
+                stage = "moving"
+    if stage == "full":
+        amount, tile_amounts = compare_frames(lastframe, frame, grid, 1, engine)
+    else:
+        amount, tile_amounts = coarse_amt, coarse_tiles
+
+    # compute an exponentially-weighted moving average (EWMA).
+    state.ewma = update_ewma(state.ewma, amount, params.ewma_alpha)
+
+    # keep a separate EWMA for each tile, restarting it if the grid changed.
+    tile_ratings = None
+    if tile_amounts is not None:
+        if state.tile_ewmas is None or len(state.tile_ewmas) != len(tile_amounts):
+            state.tile_ewmas = [None] * len(tile_amounts)
+        tile_ratings = []
+        for i, amt in enumerate(tile_amounts):
+            if amt is None:
+                state.tile_ewmas[i] = None
+                tile_ratings.append(None)
+            else:
+                state.tile_ewmas[i] = update_ewma(state.tile_ewmas[i], amt, params.ewma_alpha)
+                tile_ratings.append(motion_rating(amt, state.tile_ewmas[i]))
+
+    # learn the new frame into the background, after scoring against it.
+    if state.background is not None and params.reference == "background":
+        state.background.update(frame[2])
+
+    # use the EWMA to compute a score of the motion, and make a boolean
+    # decision about whether there is motion or not.
+    rating = motion_rating(amount, state.ewma)
+    return MotionResult(rating, rating > params.threshold, tile_ratings, stage, amount)
+
+
+# ----------------------------------------------------------------------
+
+# Per-process cache of decoded reference frames, keyed by camera.  Each entry
+# remembers the memcache generation of the frame it holds, so a lookup only
+# hits when no other worker has stored a newer frame for that camera since.
+# Entries are evicted least-recently-used first once the total size of the
+# cached sample buffers exceeds `max_bytes`.
+class FrameCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.entries = {}
+        self.order = []
+
+    # Return the size in bytes of the samples held by a frame.
+    def frame_bytes(self, frame):
+        samples = frame[2]
+        return len(samples) * getattr(samples, 'itemsize', 1)
+
+    # Return the cached frame for a camera, or None when there is no entry or
+    # the entry is not of the requested generation.
+    def get(self, camkey, generation):
+        entry = self.entries.get(camkey)
+        if entry is None or generation is None or entry[0] != generation:
+            return None
+        self.order.remove(camkey)
+        self.order.append(camkey)
+        return entry[1]
+
+    # Cache a frame (or any other decoded reference, when its `size` in bytes
+    # is given) for a camera.
+    def put(self, camkey, generation, frame, size=None):
+        self.discard(camkey)
+        if size is None:
+            size = self.frame_bytes(frame)
+        if size > self.max_bytes:
+            return
+        while self.total_bytes + size > self.max_bytes:
+            self.discard(self.order[0])
+        self.entries[camkey] = (generation, frame, size)
+        self.order.append(camkey)
+        self.total_bytes += size
+
+    def discard(self, camkey):
+        entry = self.entries.pop(camkey, None)
+        if entry is not None:
+            self.order.remove(camkey)
+            self.total_bytes -= entry[2]
+
+
+# ----------------------------------------------------------------------
+
+# Run the tests from the command line:
+# python -c 'import modetect;modetect.test()'
+
+import unittest
+
+def test():
+    unittest.main(__name__)
+
+class Test(unittest.TestCase):
+    def helperFrames(self):
+        prev = [[0.0, 0.5, 1.0, 0.25, 0.25, 0.25], [1.0, 1.0, 1.0, 0.0, 0.0, 0.0]]
+        cur = [[0.5, 0.5, 0.0, 0.25, 0.5, 0.25], [1.0, 0.0, 1.0, 0.0, 0.0, 1.0]]
+        return prev, cur
+
+    def testLegacyRating(self):
+        "Flat buffer rating matches the original per-sample loop."
+        prev, cur = self.helperFrames()
+        diffAmt = 0.0
+        for prevRow, curRow in zip(prev, cur):
+            for prevCol, curCol in zip(prevRow, curRow):
+                diffAmt += abs(curCol - prevCol)
+        legacy = 1000000.0 * diffAmt / (2 * 2 * 3.0)
+        for name in _engines:
+            engine = get_engine(name)
+            diff = engine.sad(flatten(prev, 'd'), flatten(cur, 'd'))
+            self.assertAlmostEqual(scale_rating(diff, 2, 2), legacy)
+
+    def testIntegerRating(self):
+        "Integer samples rate the same as the equivalent float samples."
+        prev, cur = self.helperFrames()
+        floatdiff = get_engine('python').sad(flatten(prev, 'd'), flatten(cur, 'd'))
+        prev = [[int(x * 4) for x in row] for row in prev]
+        cur = [[int(x * 4) for x in row] for row in cur]
+        intdiff = get_engine('python').sad(flatten(prev), flatten(cur))
+        self.assertEqual(type(intdiff), int)
+        self.assertAlmostEqual(scale_rating(intdiff, 2, 2, maxval=4),
+                               scale_rating(floatdiff, 2, 2))
+
+    def testDecodePng(self):
+        rows = [[0, 10, 20, 30, 40, 50], [255, 254, 253, 0, 1, 2]]
+        f = png.StringIO()
+        png.Writer(2, 2).write(f, rows)
+        width, height, samples, info = decode_png(f.getvalue())
+        self.assertEqual((width, height, info['planes']), (2, 2, 3))
+        self.assertEqual(frame_maxval(info), 255)
+        self.assertEqual(samples, flatten(rows))
+
+    def testRawFrame(self):
+        frame = (2, 1, array('B', [1, 2, 3, 250, 251, 252]),
+                 dict(planes=3, bitdepth=8))
+        data = encode_frame(frame, 42)
+        self.assertEqual(len(data), RAW_HEADER_SIZE + 6)
+        (width, height, samples, info), generation = decode_frame(data)
+        self.assertEqual((width, height, generation), (2, 1, 42))
+        self.assertEqual(samples, frame[2])
+        self.assertEqual((info['planes'], info['bitdepth']), (3, 8))
+        frame = (1, 1, array('H', [0x1234]), dict(planes=1, bitdepth=16))
+        data = encode_frame(frame)
+        self.assertEqual(data[-2:], '\x12\x34')
+        self.assertEqual(decode_frame(data)[0][2], frame[2])
+        self.assertRaises(ValueError, decode_frame, data[:-1])
+        self.assertRaises(ValueError, decode_frame, 'XX' + data[2:])
+
+    def testLuma(self):
+        for name in _engines:
+            engine = get_engine(name)
+            rgb = (3, 1, array('B', [255, 0, 0, 0, 255, 0, 10, 20, 30]),
+                   dict(planes=3, bitdepth=8))
+            width, height, luma, info = to_luma(rgb, engine)
+            self.assertEqual((width, height, info['planes'], info['bitdepth']), (3, 1, 1, 8))
+            self.assertEqual(list(luma), [77, 149, 18])
+            grey = (2, 1, array('B', [85] * 3 + [170] * 3), dict(planes=3, bitdepth=8))
+            self.assertEqual(list(to_luma(grey, engine)[2]), [85, 170])
+            grey16 = (2, 1, array('H', [0xffff, 9, 0x8000, 9]), dict(planes=2, bitdepth=16))
+            self.assertEqual(list(to_luma(grey16, engine)[2]), [255, 128])
+            grey2 = (2, 1, array('B', [1, 3]), dict(planes=1, bitdepth=2))
+            self.assertEqual(list(to_luma(grey2, engine)[2]), [85, 255])
+
+    def testSadBytes(self):
+        for name in _engines:
+            engine = get_engine(name)
+            self.assertEqual(engine.sad('\x00\x10\xff', array('B', [5, 0, 0])), 276)
+            self.assertRaises(ValueError, engine.sad, '\x00', '\x00\x00')
+
+    def testBatch(self):
+        pairs = [('\x00\x00', '\x01\x02'), ('\xff\xff', '\x00\xff'), ('\x07', '\x07')]
+        for name in _engines:
+            self.assertEqual(get_engine(name).sad_batch(pairs), [3, 255, 0])
+        ratings = rate_batch(pairs[:2], 1, 1, planes=2, maxval=255.0)
+        self.assertAlmostEqual(ratings[1], 500000.0)
+
+    def testSubsample(self):
+        samples = array('B', range(4 * 3 * 2))
+        coarse = subsample(samples, 4, 3, 2, 2)
+        # pixels (0,0), (2,0), (0,2) and (2,2), with their samples together.
+        self.assertEqual(list(coarse), [0, 1, 4, 5, 16, 17, 20, 21])
+        self.assertEqual(subsample(samples, 4, 3, 2, 1), samples)
+        self.assertEqual(list(subsample(samples, 4, 3, 2, 3)), [0, 1, 6, 7])
+
+    def helperTiles(self):
+        width, height, planes = 5, 4, 2
+        prev = array('B', [0]) * (width * height * planes)
+        cur = array('B', [(i * 7) % 11 for i in range(width * height * planes)])
+        return width, height, planes, prev, cur
+
+    def testIntegralImage(self):
+        width, height, planes, prev, cur = self.helperTiles()
+        grid = TileGrid(width, height, 2, 2)
+        pixel = lambda x, y: sum(cur[(y*width+x)*planes:(y*width+x+1)*planes])
+        for name in _engines:
+            sat = grid.integral(prev, cur, planes, get_engine(name))
+            for x0, y0, x1, y1 in [(0, 0, 5, 4), (1, 1, 4, 3), (2, 0, 3, 4), (4, 3, 5, 4)]:
+                expect = sum([pixel(x, y) for x in range(x0, x1) for y in range(y0, y1)])
+                self.assertEqual(grid.region_sum(sat, x0, y0, x1, y1), expect)
+            sums = grid.tile_sums(sat)
+            self.assertEqual(len(sums), 4)
+            self.assertEqual(sum(sums), sum(cur))
+            self.assertEqual(sums[3], grid.region_sum(sat, 2, 2, 5, 4))
+
+    def testTileMask(self):
+        width, height, planes, prev, cur = self.helperTiles()
+        full = TileGrid(width, height, 2, 2)
+        grid = TileGrid(width, height, 2, 2, parse_mask('1001', 4))
+        for name in _engines:
+            engine = get_engine(name)
+            fullsums = full.tile_sums(full.integral(prev, cur, planes, engine))
+            sums = grid.tile_sums(grid.integral(prev, cur, planes, engine))
+            self.assertEqual(sums, [fullsums[0], None, None, fullsums[3]])
+        self.assertEqual(grid.included_area(), 2*2 + 3*2)
+        self.assertRaises(ValueError, parse_mask, '101', 4)
+        self.assertRaises(ValueError, parse_mask, '10x1', 4)
+        self.assertEqual(parse_mask('', 4), None)
+        self.assertRaises(ValueError, TileGrid, 2, 2, 3, 1)
+
+    def testTiledCoarse(self):
+        width, height, planes, prev, cur = self.helperTiles()
+        info = dict(planes=planes, bitdepth=8)
+        grid = TileGrid(width, height, 2, 2, parse_mask('1101', 4))
+        small = TileGrid(3, 2, 2, 2, parse_mask('1101', 4))
+        for name in _engines:
+            engine = get_engine(name)
+            amount, tiles = compare_frames((width, height, prev, info),
+                                           (width, height, cur, info),
+                                           grid, 2, engine)
+            expect = compare_frames((3, 2, subsample(prev, width, height, planes, 2), info),
+                                    (3, 2, subsample(cur, width, height, planes, 2), info),
+                                    small, 1, engine)
+            self.assertEqual((amount, tiles), expect)
+            self.assertEqual(tiles[2], None)
+            # a 2x2 grid does not fit the 2x1 pixels left by a step of 4.
+            self.assertEqual(compare_frames((width, height, prev, info),
+                                            (width, height, cur, info),
+                                            grid, 4, engine), (0.5, None))
+
+    def testMotionRating(self):
+        self.assertEqual(update_ewma(None, 5.0, 0.25), 5.0)
+        self.assertEqual(update_ewma(4.0, 8.0, 0.25), 5.0)
+        self.assertEqual(motion_rating(7.5, 5.0), 50)
+        self.assertEqual(motion_rating(50.0, 5.0), 100)
+        self.assertEqual(motion_rating(0, 5.0), 0)
+
+    def testBackgroundModel(self):
+        frame = (2, 1, array('B', [100, 0]), dict(planes=1, bitdepth=8))
+        model = BackgroundModel(2, 1, 1, shift=2, variance=True)
+        self.assert_(model.matches(frame))
+        self.assert_(not model.matches((1, 2, frame[2], frame[3])))
+        mean, samples = model.mean, model.samples
+        model.update(frame[2])
+        self.assertEqual(list(samples), [100, 0])
+        model.update(array('B', [200, 0]))
+        # alpha is 1/4, so the mean moves a quarter of the way to the new sample.
+        self.assertEqual(list(samples), [125, 0])
+        self.assertEqual(model.mean[0], 125 << BackgroundModel.FRAC)
+        self.assertEqual(list(model.variance), [2500, 0])
+        # Updates keep the arrays.
+        self.assert_(model.mean is mean and model.samples is samples)
+        self.assert_(model.reference()[2] is samples)
+        # The first sample has a mean of 125 and a deviation of 50, so only
+        # change beyond 2.5 deviations (125) from the mean counts.
+        for model.use_numpy in (False, True)[:1 + (numpy is not None)]:
+            reference = model.reference(array('B', [255, 3]))[2]
+            self.assertEqual(list(reference), [250, 0])
+            self.assertEqual(list(model.reference(array('B', [60, 0]))[2]), [60, 0])
+        del model.use_numpy
+        copy = BackgroundModel.fromstring(model.tostring())
+        self.assertEqual((copy.frames, copy.shift), (2, 2))
+        self.assertEqual(copy.mean, model.mean)
+        self.assertEqual(copy.variance, model.variance)
+        self.assertEqual(copy.samples, model.samples)
+        self.assertRaises(ValueError, BackgroundModel.fromstring, model.tostring()[:-1])
+
+    def testBackgroundUpdate(self):
+        # Both ways of updating agree with the update done sample by sample.
+        frac, shift = BackgroundModel.FRAC, 3
+        frames = [array('H', [(i * 7919 + n * 104729) % 65536 for i in range(60)])
+                  for n in range(4)]
+        mean, var = [s << frac for s in frames[0]], [0] * 60
+        for samples in frames[1:]:
+            for i in range(60):
+                d = (samples[i] << frac) - mean[i]
+                mean[i] += d >> shift
+                var[i] += (((d * d) >> (2 * frac)) - var[i]) >> shift
+        rounded = [(m + (1 << (frac - 1))) >> frac for m in mean]
+        for use_numpy in (False, True)[:1 + (numpy is not None)]:
+            model = BackgroundModel(6, 10, 1, 16, shift, variance=True)
+            model.use_numpy = use_numpy
+            for samples in frames:
+                model.update(samples)
+            self.assertEqual(list(model.mean), mean)
+            self.assertEqual(list(model.variance), var)
+            self.assertEqual(list(model.samples), rounded)
+            copy = BackgroundModel.fromstring(model.tostring())
+            self.assertEqual(list(copy.samples), rounded)
+
+    def testDetectMotion(self):
+        still = (4, 4, array('B', [10]) * 48, dict(planes=3, bitdepth=8))
+        moved = (4, 4, array('B', [10]) * 40 + array('B', [250]) * 8,
+                 dict(planes=3, bitdepth=8))
+        # An object that arrives and stays put only differs from the previous
+        # frame once, but keeps differing from the background for a while.
+        expect = dict(frame=[False, False, False, True, False],
+                      background=[False, False, False, True, True])
+        for reference in expect:
+            params = MotionParams(reference=reference, coarse_step=1)
+            state = MotionState()
+            found = []
+            for frame in [still, still, still, moved, moved]:
+                result = detect_motion(prepare_frame(frame, params), state, params)
+                found.append(result.found)
+            self.assertEqual(found, expect[reference])
+        self.assertRaises(ValueError, MotionParams, thresold=3)
+
+    def testFrameCache(self):
+        frame = lambda n: (1, 1, array('B', [0]) * n, {})
+        cache = FrameCache(100)
+        cache.put('a', 1, frame(40))
+        cache.put('b', 7, frame(40))
+        self.assertEqual(cache.get('a', 2), None)
+        self.assertEqual(len(cache.get('a', 1)[2]), 40)
+        # 'b' is now the least recently used entry.
+        cache.put('c', 1, frame(40))
+        self.assertEqual(cache.get('b', 7), None)
+        self.assertEqual(cache.total_bytes, 80)
+        cache.put('a', 2, frame(10))
+        self.assertEqual(cache.get('a', 1), None)
+        self.assertEqual(cache.total_bytes, 50)
+        # Frames bigger than the whole cache are never stored.
+        cache.put('d', 1, frame(101))
+        self.assertEqual(cache.get('d', 1), None)
+
+    def testParseParam(self):
+        self.assertEqual(parse_param('threshold', '40'), 40)
+        self.assertEqual(parse_param('ewma_alpha', '1'), 1.0)
+        self.assertEqual(parse_param('background_variance', 'True'), True)
+        self.assertEqual(parse_param('mask', '0110'), '0110')
+        self.assertEqual(parse_param('mode', 'luma'), 'luma')
+        self.assertRaises(ValueError, parse_param, 'grid', 'two')
+        self.assertRaises(ValueError, parse_param, 'background_variance', '1')
+        self.assertRaises(ValueError, parse_param, 'speed', '1')
+
+    def testUnknownEngine(self):
+        self.assertRaises(ValueError, get_engine, 'abacus')
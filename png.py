@@ -181,8 +181,15 @@ import zlib
 # http://www.python.org/doc/2.4.4/lib/module-warnings.html
 import warnings
 
+# numpy is optional; when it is available it is used to speed up
+# decoding (see :meth:`Reader.undo_filter`).
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
-__all__ = ['Image', 'Reader', 'Writer', 'write_chunks', 'from_array']
+__all__ = ['Image', 'Reader', 'Writer', 'write_chunks', 'from_array', 'probe']
 
 
 # The PNG signature.
@@ -226,6 +233,100 @@ else:
         return row.tostring()
         
 
+def unpack_uint16(bytes):
+    """Convert bytes holding big-endian (network order) 16-bit values,
+    as found in a PNG file, to an ``array('H')``.  `bytes` is a string
+    or an ``array('B')``.  The bytes are reinterpreted as the array
+    and byteswapped in place when the host is little-endian, rather
+    than unpacked value by value.
+    """
+
+    if isarray(bytes):
+        bytes = tostring(bytes)
+    a = array('H')
+    a.fromstring(bytes)
+    if sys.byteorder != 'big':
+        a.byteswap()
+    return a
+
+def pack_uint16(values):
+    """Convert a sequence of 16-bit values to a string of their bytes,
+    big-endian (network order), as stored in a PNG file.  The inverse of
+    :func:`unpack_uint16`.
+    """
+
+    if isarray(values) and values.typecode == 'H':
+        # Copy by slicing; the byteswap must not change the caller's
+        # array.
+        a = values[:]
+    else:
+        a = array('H', values)
+    if sys.byteorder != 'big':
+        a.byteswap()
+    return a.tostring()
+
+# Tables for unpacking samples of bit depth 1, 2, and 4; see
+# :func:`unpack_table`.
+_unpack_tables = {}
+
+# Tables of sample conversions, by key and bit depth; see
+# :meth:`Reader.value_mapper`.
+_value_tables = {}
+
+def unpack_table(bitdepth):
+    """Return a 256-entry table that maps a byte packed with samples of
+    `bitdepth` bits (1, 2, or 4) to a string of those samples, most
+    significant first, one sample per character.  Unpacking a row is
+    then a single ``''.join(map(table.__getitem__, row))``.  Tables are
+    built on first use.
+    """
+
+    table = _unpack_tables.get(bitdepth)
+    if table is None:
+        spb = 8//bitdepth
+        mask = 2**bitdepth - 1
+        shifts = map(bitdepth.__mul__, reversed(range(spb)))
+        table = [''.join([chr(mask&(o>>i)) for i in shifts])
+                 for o in range(256)]
+        _unpack_tables[bitdepth] = table
+    return table
+
+_pack_tables = {}
+
+def pack_table(bitdepth):
+    """Return a dictionary that maps a string of ``8//bitdepth``
+    samples of `bitdepth` bits (1, 2, or 4), one sample per character,
+    to the byte (as a character) that they pack into, most significant
+    first.  It is the inverse of :func:`unpack_table`.  Tables are
+    built on first use.
+    """
+
+    table = _pack_tables.get(bitdepth)
+    if table is None:
+        table = dict(zip(unpack_table(bitdepth), map(chr, range(256))))
+        _pack_tables[bitdepth] = table
+    return table
+
+def pack_samples(values, bitdepth):
+    """Pack a sequence of samples of `bitdepth` bits (1, 2, or 4) into
+    bytes, most significant first, as in a PNG scanline; the last byte
+    is padded with zero bits.  Return a string.  Each byte is looked up
+    in :func:`pack_table` by the string of the samples it packs.
+    """
+
+    spb = 8//bitdepth
+    if isarray(values) and values.typecode == 'B':
+        s = values.tostring()
+    else:
+        s = array('B', values).tostring()
+    # Pad to a whole number of bytes.
+    s += '\0' * (-len(s) % spb)
+    try:
+        return ''.join(map(pack_table(bitdepth).__getitem__,
+                           struct.unpack('%ds' % spb * (len(s)//spb), s)))
+    except KeyError:
+        raise ValueError("sample too big for bit depth %d" % bitdepth)
+
 def interleave_planes(ipixels, apixels, ipsize, apsize):
     """
     Interleave (colour) planes, e.g. RGB + A = RGBA.
@@ -304,6 +405,11 @@ class Writer:
     PNG encoder in pure Python.
     """
 
+    # Whether :meth:`filter_rows` uses numpy when it is available.  Set
+    # this to False (on the class or on an instance) to force the pure
+    # Python code.
+    use_numpy = True
+
     def __init__(self, width=None, height=None,
                  size=None,
                  greyscale=False,
@@ -319,7 +425,9 @@ class Writer:
                  planes=None,
                  colormap=None,
                  maxval=None,
-                 chunk_limit=2**20):
+                 chunk_limit=2**20,
+                 filter_type=0,
+                 threads=1):
         """
         Create a PNG encoder object.
 
@@ -349,6 +457,10 @@ class Writer:
           Create an interlaced image.
         chunk_limit
           Write multiple ``IDAT`` chunks to save memory.
+        filter_type
+          Scanline filter: 0 to 4, or ``'adaptive'``.
+        threads
+          Compress the image on this many threads.
 
         The image size (in pixels) can be specified either by using the
         `width` and `height` arguments, or with the single `size`
@@ -435,6 +547,23 @@ class Writer:
         `chunk_limit` is used to limit the amount of memory used whilst
         compressing the image.  In order to avoid using large amounts of
         memory, multiple ``IDAT`` chunks may be created.
+
+        `filter_type` selects the filter applied to each scanline
+        before compression (see
+        http://www.w3.org/TR/PNG/#9Filters ).  A number from 0 to 4
+        uses that filter for every scanline; the default, 0, is no
+        filtering, which is the fastest.  ``'adaptive'`` chooses a
+        filter for each scanline: the one whose filtered bytes, taken as
+        signed values, have the smallest sum of absolute values.  This
+        usually compresses best, but it filters every scanline 5 times.
+
+        `threads` greater than 1 splits the image data into bands that
+        are compressed independently, in parallel (zlib releases the
+        GIL whilst it compresses).  The bands are joined into a single
+        zlib stream, so the PNG file is no different in structure, but
+        because no band can refer back to data in an earlier band the
+        compression is slightly worse.  A band is never more than
+        `chunk_limit` bytes of image data.
         """
 
         # At the moment the `planes` argument is ignored;
@@ -560,6 +689,11 @@ class Writer:
         if bitdepth > 8 and palette:
             raise ValueError(
                 "bit depth must be 8 or less for images with palette")
+        if filter_type not in (0,1,2,3,4,'adaptive'):
+            raise ValueError(
+              "filter_type must be 0 to 4 or 'adaptive'")
+        if threads < 1:
+            raise ValueError("threads must be 1 or more")
 
         transparent = check_color(transparent, 'transparent')
         background = check_color(background, 'background')
@@ -578,6 +712,8 @@ class Writer:
         self.bitdepth = int(bitdepth)
         self.compression = compression
         self.chunk_limit = chunk_limit
+        self.filter_type = filter_type
+        self.threads = int(threads)
         self.interlace = bool(interlace)
         self.palette = check_palette(palette)
 
@@ -653,27 +789,74 @@ class Writer:
 
         """
 
+        nrows = [0]
         # http://www.w3.org/TR/PNG/#5PNG-file-signature
         outfile.write(_signature)
+        for tag, data in self.chunks(rows, packed, nrows):
+            write_chunk(outfile, tag, data)
+        return nrows[0]
+
+    def stream_passes(self, rows, packed=False):
+        """
+        Generate a PNG image, in pieces, from `rows` (as for
+        :meth:`write_passes`).  Each piece is a string: first the PNG
+        signature, then each chunk, including its length and checksum,
+        as soon as it is complete.  So the image can be sent as it is
+        encoded, and only one ``IDAT`` chunk (and the rows that it
+        holds) needs to be in memory.
+        """
+
+        yield _signature
+        for tag, data in self.chunks(rows, packed, [0]):
+            yield chunk_bytes(tag, data)
+
+    def stream(self, rows):
+        """Generate a PNG image, in pieces, from `rows` in boxed row
+        flat pixel format (as for :meth:`write`).  See
+        :meth:`stream_passes`.
+        """
+
+        if self.interlace:
+            fmt = 'BH'[self.bitdepth > 8]
+            a = array(fmt, itertools.chain(*rows))
+            rows = self.array_scanlines_interlace(a)
+        nrows = [0]
+        yield _signature
+        for tag, data in self.chunks(rows, False, nrows):
+            yield chunk_bytes(tag, data)
+        if not self.interlace and nrows[0] != self.height:
+            raise ValueError(
+              "rows supplied (%d) does not match height (%d)" %
+              (nrows[0], self.height))
+
+    def chunks(self, rows, packed=False, nrows=None):
+        """Generate the chunks of a PNG image, from `rows` (as for
+        :meth:`write_passes`), as (*type*, *data*) pairs.  If `nrows`
+        is given, the number of rows is stored in ``nrows[0]`` once they
+        have all been used.
+        """
+
+        if nrows is None:
+            nrows = [0]
 
         # http://www.w3.org/TR/PNG/#11IHDR
-        write_chunk(outfile, 'IHDR',
-                    struct.pack("!2I5B", self.width, self.height,
-                                self.bitdepth, self.color_type,
-                                0, 0, self.interlace))
+        yield ('IHDR',
+               struct.pack("!2I5B", self.width, self.height,
+                           self.bitdepth, self.color_type,
+                           0, 0, self.interlace))
 
         # See :chunk:order
         # http://www.w3.org/TR/PNG/#11gAMA
         if self.gamma is not None:
-            write_chunk(outfile, 'gAMA',
-                        struct.pack("!L", int(round(self.gamma*1e5))))
+            yield ('gAMA',
+                   struct.pack("!L", int(round(self.gamma*1e5))))
 
         # See :chunk:order
         # http://www.w3.org/TR/PNG/#11sBIT
         if self.rescale:
-            write_chunk(outfile, 'sBIT',
-                struct.pack('%dB' % self.planes,
-                            *[self.rescale[0]]*self.planes))
+            yield ('sBIT',
+                   struct.pack('%dB' % self.planes,
+                               *[self.rescale[0]]*self.planes))
         
         # :chunk:order: Without a palette (PLTE chunk), ordering is
         # relatively relaxed.  With one, gAMA chunk must precede PLTE
@@ -681,64 +864,67 @@ class Writer:
         # See http://www.w3.org/TR/PNG/#5ChunkOrdering
         if self.palette:
             p,t = self.make_palette()
-            write_chunk(outfile, 'PLTE', p)
+            yield ('PLTE', p)
             if t:
                 # tRNS chunk is optional.  Only needed if palette entries
                 # have alpha.
-                write_chunk(outfile, 'tRNS', t)
+                yield ('tRNS', t)
 
         # http://www.w3.org/TR/PNG/#11tRNS
         if self.transparent is not None:
             if self.greyscale:
-                write_chunk(outfile, 'tRNS',
-                            struct.pack("!1H", *self.transparent))
+                yield ('tRNS',
+                       struct.pack("!1H", *self.transparent))
             else:
-                write_chunk(outfile, 'tRNS',
-                            struct.pack("!3H", *self.transparent))
+                yield ('tRNS',
+                       struct.pack("!3H", *self.transparent))
 
         # http://www.w3.org/TR/PNG/#11bKGD
         if self.background is not None:
             if self.greyscale:
-                write_chunk(outfile, 'bKGD',
-                            struct.pack("!1H", *self.background))
+                yield ('bKGD',
+                       struct.pack("!1H", *self.background))
             else:
-                write_chunk(outfile, 'bKGD',
-                            struct.pack("!3H", *self.background))
+                yield ('bKGD',
+                       struct.pack("!3H", *self.background))
 
         # http://www.w3.org/TR/PNG/#11IDAT
-        if self.compression is not None:
-            compressor = zlib.compressobj(self.compression)
+        level = self.compression
+        if level is None:
+            level = zlib.Z_DEFAULT_COMPRESSION
+        limit = self.chunk_limit
+        if self.threads > 1:
+            compressor = _ParallelCompressor(level, self.threads)
+            # Give each thread a share of the image data, in bands big
+            # enough to compress reasonably well.
+            share = -(-self.idat_size() // self.threads)
+            limit = min(limit, max(share, _MIN_BAND))
         else:
-            compressor = zlib.compressobj()
+            compressor = zlib.compressobj(level)
 
         # Choose an extend function based on the bitdepth.  The extend
         # function packs/decomposes the pixel values into bytes and
         # stuffs them onto the data array.
         data = array('B')
-        if self.bitdepth == 8 or packed:
+        if packed:
+            def extend(row):
+                # Packed rows can also be strings.
+                if isinstance(row, str):
+                    data.fromstring(row)
+                else:
+                    data.extend(row)
+        elif self.bitdepth == 8:
             extend = data.extend
         elif self.bitdepth == 16:
             # Decompose into bytes
             def extend(sl):
-                fmt = '!%dH' % len(sl)
-                data.extend(array('B', struct.pack(fmt, *sl)))
+                data.fromstring(pack_uint16(sl))
         else:
             # Pack into bytes
             assert self.bitdepth < 8
-            # samples per byte
-            spb = int(8/self.bitdepth)
+            bitdepth = self.bitdepth
             def extend(sl):
-                a = array('B', sl)
-                # Adding padding bytes so we can group into a whole
-                # number of spb-tuples.
-                l = float(len(a))
-                extra = math.ceil(l / float(spb))*spb - l
-                a.extend([0]*int(extra))
-                # Pack into bytes
-                l = group(a, spb)
-                l = map(lambda e: reduce(lambda x,y:
-                                           (x << self.bitdepth) + y, e), l)
-                data.extend(l)
+                data.fromstring(pack_samples(sl, bitdepth))
         if self.rescale:
             oldextend = extend
             factor = \
@@ -754,12 +940,28 @@ class Writer:
         enumrows = enumerate(rows)
         del rows
 
+        # Each row is added to data with filter type 0 ("None"), and if
+        # another filter is wanted the rows are filtered in place, a
+        # band at a time, before they are compressed.  A band never
+        # spans two reduced pass images, because the first row of each
+        # pass has no previous line to filter against.
+        filter_type = self.filter_type
+        starts = self.pass_starts()
+        # The previous (unfiltered) line, and the band.
+        prev = None
+        bandstart = 0
+        bandrows = 1
+
         # First row's filter type.
         data.append(0)
-        # :todo: Certain exceptions in the call to ``.next()`` or the
-        # following try would indicate no row data supplied.
-        # Should catch.
-        i,row = enumrows.next()
+        # :todo: Certain exceptions in the following try would
+        # indicate no row data supplied.  Should catch.
+        try:
+            i,row = enumrows.next()
+        except StopIteration:
+            # Inside this generator a StopIteration would simply end
+            # the image, after the IHDR chunk.
+            raise ValueError("no rows supplied")
         try:
             # If this fails...
             extend(row)
@@ -775,23 +977,29 @@ class Writer:
             extend(row)
 
         for i,row in enumrows:
-            # Add "None" filter type.  Currently, it's essential that
-            # this filter type be used for every scanline as we do not
-            # mark the first row of a reduced pass image; that means we
-            # could accidentally compute the wrong filtered scanline if
-            # we used "up", "average", or "paeth" on such a line.
+            if filter_type and i in starts:
+                self.filter_rows(data, bandstart, bandrows, prev)
+                prev = None
+                bandstart = len(data)
+                bandrows = 0
             data.append(0)
             extend(row)
-            if len(data) > self.chunk_limit:
+            bandrows += 1
+            if len(data) > limit:
+                if filter_type:
+                    prev = self.filter_rows(data, bandstart, bandrows, prev)
+                    bandstart = bandrows = 0
                 compressed = compressor.compress(tostring(data))
                 if len(compressed):
                     # print >> sys.stderr, len(data), len(compressed)
-                    write_chunk(outfile, 'IDAT', compressed)
+                    yield ('IDAT', compressed)
                 # Because of our very witty definition of ``extend``,
                 # above, we must re-use the same ``data`` object.  Hence
                 # we use ``del`` to empty this one, rather than create a
                 # fresh one (which would be my natural FP instinct).
                 del data[:]
+        if filter_type:
+            self.filter_rows(data, bandstart, bandrows, prev)
         if len(data):
             compressed = compressor.compress(tostring(data))
         else:
@@ -799,10 +1007,66 @@ class Writer:
         flushed = compressor.flush()
         if len(compressed) or len(flushed):
             # print >> sys.stderr, len(data), len(compressed), len(flushed)
-            write_chunk(outfile, 'IDAT', compressed + flushed)
+            yield ('IDAT', compressed + flushed)
+        nrows[0] = i+1
         # http://www.w3.org/TR/PNG/#11IEND
-        write_chunk(outfile, 'IEND')
-        return i+1
+        yield ('IEND', '')
+
+    def idat_size(self):
+        """Return the number of bytes of image data (before
+        compression): the filter type byte and the scanline of every row
+        (of every pass, for interlaced images).
+        """
+
+        if not self.interlace:
+            passes = [(0, 0, 1, 1)]
+        else:
+            passes = _adam7
+        size = 0
+        for xstart, ystart, xstep, ystep in passes:
+            if xstart >= self.width or ystart >= self.height:
+                continue
+            ppr = int(math.ceil((self.width-xstart)/float(xstep)))
+            row_size = int(math.ceil(self.bitdepth * self.planes * ppr / 8.0))
+            rows = int(math.ceil((self.height-ystart)/float(ystep)))
+            size += rows * (row_size + 1)
+        return size
+
+    def pass_starts(self):
+        """Return a dictionary whose keys are the numbers of the rows
+        (in the order they are written) that start a reduced pass image;
+        just row 0 for a straightlaced image.
+        """
+
+        starts = {0: True}
+        if not self.interlace:
+            return starts
+        rows = 0
+        for xstart, ystart, xstep, ystep in _adam7:
+            if xstart >= self.width:
+                continue
+            starts[rows] = True
+            rows += len(range(ystart, self.height, ystep))
+        return starts
+
+    def filter_rows(self, data, start, rows, prev):
+        """Filter, in place and according to the `filter_type` of the
+        Writer, the band of `rows` scanlines that ends `data` (see
+        :func:`filter_band`).  `prev` is the previous (unfiltered) line
+        of the pass, or ``None`` when the band starts a pass.  Returns
+        the last unfiltered line, to be passed as `prev` for the next
+        band.
+        """
+
+        if not rows:
+            return prev
+        # Filter offset: bytes per pixel, but at least 1.
+        fo = max(1, self.psize)
+        if self.use_numpy and numpy:
+            f = _filter_band_numpy
+        else:
+            f = filter_band
+        return f(self.filter_type, data, start, rows, fo, prev)
 
     def write_array(self, outfile, pixels):
         """
@@ -819,7 +1083,9 @@ class Writer:
         """
         Write PNG file to `outfile`.  The pixel data comes from `rows`
         which should be in boxed row packed format.  Each row should be
-        a sequence of packed bytes.
+        a sequence of packed bytes, or a string.  This is the fastest
+        way to write an image, since the rows need no conversion; for
+        bit depths less than 8, :func:`pack_samples` packs a row.
 
         Technically, this method does work for interlaced images but it
         is best avoided.  For interlaced images, the rows should be
@@ -888,9 +1154,8 @@ class Writer:
         if self.bitdepth > 8:
             assert self.bitdepth == 16
             row_bytes *= 2
-            fmt = '>%dH' % vpr
             def line():
-                return array('H', struct.unpack(fmt, infile.read(row_bytes)))
+                return unpack_uint16(infile.read(row_bytes))
         else:
             def line():
                 scanline = array('B', infile.read(row_bytes))
@@ -948,19 +1213,126 @@ class Writer:
                             pixels[offset+i:end_offset:skip]
                     yield row
 
+# The smallest band, in bytes, that a Writer with several threads
+# compresses on its own.
+_MIN_BAND = 2**16
+
+def adler32_combine(adler1, adler2, length2):
+    """Return the Adler-32 checksum of the concatenation of two strings,
+    given the checksum of each (`adler1` and `adler2`) and the length of
+    the second, `length2`.  Checksums are treated as unsigned.
+    """
+
+    # http://tools.ietf.org/html/rfc1950#section-8.2
+    # Appending n bytes to a string adds the sum of those bytes to the
+    # low half (s1) of its checksum, and n times its s1 as well as the
+    # high half (s2) of their own checksum to the high half.
+    base = 65521
+    n = length2 % base
+    s1 = adler1 & 0xffff
+    s2 = (adler1 >> 16) & 0xffff
+    t1 = adler2 & 0xffff
+    t2 = (adler2 >> 16) & 0xffff
+    # t1 and t2 already include the initial 1 of the second checksum.
+    r1 = (s1 + t1 - 1) % base
+    r2 = (s2 + t2 + n * s1 - n) % base
+    return (r2 << 16) | r1
+
+class _ParallelCompressor:
+    """A substitute for a ``zlib.compressobj`` that compresses every
+    string passed to :meth:`compress` as a separate band, on a thread of
+    its own, with at most `threads` bands in progress at once.
+
+    Each band is raw deflate data that ends with a full flush, so it
+    finishes on a byte boundary and is independent of every other band.
+    Joined, and given a zlib header, a final empty block and the Adler-32
+    checksum (combined from the checksums of the bands), they make a
+    single, ordinary zlib stream.
+    """
+
+    def __init__(self, level, threads):
+        import threading
+        self.Thread = threading.Thread
+        self.level = level
+        self.threads = threads
+        # The zlib header, which only depends on the level.
+        self.header = zlib.compressobj(level).flush()[:2]
+        self.adler = 1
+        # Bands in progress, oldest first, as (thread, result, length)
+        # triples.
+        self.pending = []
+
+    def compress(self, string):
+        """Start compressing `string` as a band.  When `threads` bands
+        are already in progress, first wait for the oldest one and
+        return it (otherwise return an empty string).  Which bands come
+        out of which call depends only on the calls made, never on
+        thread timing, so the chunks of the PNG file are the same from
+        one run to the next.
+        """
+
+        if not string:
+            return ''
+        out = []
+        while len(self.pending) >= self.threads:
+            out.append(self.finish())
+        result = []
+        def band():
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                          -zlib.MAX_WBITS)
+            result.append(compressor.compress(string) +
+                          compressor.flush(zlib.Z_FULL_FLUSH))
+            result.append(zlib.adler32(string) & 0xffffffff)
+        thread = self.Thread(target=band)
+        thread.start()
+        self.pending.append((thread, result, len(string)))
+        return ''.join(out)
+
+    def finish(self):
+        """Wait for the oldest band in progress, and return it."""
+
+        thread, result, length = self.pending.pop(0)
+        thread.join()
+        if len(result) != 2:
+            raise Error("band compression failed")
+        compressed, adler = result
+        self.adler = adler32_combine(self.adler, adler, length)
+        if self.header:
+            compressed = self.header + compressed
+            self.header = ''
+        return compressed
+
+    def flush(self):
+        """Wait for every band in progress, and return them followed by
+        the end of the zlib stream."""
+
+        out = []
+        while self.pending:
+            out.append(self.finish())
+        # A final, empty, block.
+        out.append(self.header + zlib.compressobj(self.level,
+                     zlib.DEFLATED, -zlib.MAX_WBITS).flush())
+        out.append(struct.pack('!L', self.adler))
+        return ''.join(out)
+
 def write_chunk(outfile, tag, data=''):
     """
     Write a PNG chunk to the output file, including length and
     checksum.
     """
 
+    outfile.write(chunk_bytes(tag, data))
+
+def chunk_bytes(tag, data=''):
+    """
+    Return a PNG chunk, including length and checksum, as a string.
+    """
+
     # http://www.w3.org/TR/PNG/#5Chunk-layout
-    outfile.write(struct.pack("!I", len(data)))
-    outfile.write(tag)
-    outfile.write(data)
     checksum = zlib.crc32(tag)
     checksum = zlib.crc32(data, checksum)
-    outfile.write(struct.pack("!i", checksum))
+    return ''.join([struct.pack("!I", len(data)), tag, data,
+                    struct.pack("!i", checksum)])
 
 def write_chunks(out, chunks):
     """Create a PNG file by writing out the chunks."""
@@ -969,7 +1341,11 @@ def write_chunks(out, chunks):
     for chunk in chunks:
         write_chunk(out, *chunk)
 
-def filter_scanline(type, line, fo, prev=None):
+# Cost of a filtered byte, used to choose a filter adaptively: its
+# magnitude as a signed byte.
+_filter_cost = map(lambda x: min(x, 256 - x), range(256))
+
+def filter_scanline(type, line, fo, prev=None, out=None):
     """Apply a scanline filter to a scanline.  `type` specifies the
     filter type (0 to 4); `line` specifies the current (unfiltered)
     scanline as a sequence of bytes; `prev` specifies the previous
@@ -977,57 +1353,16 @@ def filter_scanline(type, line, fo, prev=None):
     filter offset; normally this is size of a pixel in bytes (the number
     of bytes per sample times the number of channels), but when this is
     < 1 (for bit depths < 8) then the filter offset is 1.
+
+    The filter type byte followed by the filtered scanline is returned
+    as an ``array('B')``; it is written to `out` if that is given (it
+    must be an ``array('B')`` one byte longer than `line`).
     """
 
     assert 0 <= type < 5
 
-    # The output array.  Which, pathetically, we extend one-byte at a
-    # time (fortunately this is linear).
-    out = array('B', [type])
-
-    def sub():
-        ai = -fo
-        for x in line:
-            if ai >= 0:
-                x = (x - line[ai]) & 0xff
-            out.append(x)
-            ai += 1
-    def up():
-        for i,x in enumerate(line):
-            x = (x - prev[i]) & 0xff
-            out.append(x)
-    def average():
-        ai = -fo
-        for i,x in enumerate(line):
-            if ai >= 0:
-                x = (x - ((line[ai] + prev[i]) >> 1)) & 0xff
-            else:
-                x = (x - (prev[i] >> 1)) & 0xff
-            out.append(x)
-            ai += 1
-    def paeth():
-        # http://www.w3.org/TR/PNG/#9Filter-type-4-Paeth
-        ai = -fo # also used for ci
-        for i,x in enumerate(line):
-            a = 0
-            b = prev[i]
-            c = 0
-
-            if ai >= 0:
-                a = line[ai]
-                c = prev[ai]
-            p = a + b - c
-            pa = abs(p - a)
-            pb = abs(p - b)
-            pc = abs(p - c)
-            if pa <= pb and pa <= pc: Pr = a
-            elif pb <= pc: Pr = b
-            else: Pr = c
-
-            x = (x - Pr) & 0xff
-            out.append(x)
-            ai += 1
-
+    if not isarray(line):
+        line = array('B', line)
     if not prev:
         # We're on the first line.  Some of the filters can be reduced
         # to simpler cases which makes handling the line "off the top"
@@ -1035,23 +1370,101 @@ def filter_scanline(type, line, fo, prev=None):
         # "left" (non-trivial, but true). "average" needs to be handled
         # specially.
         if type == 2: # "up"
-            return line # type = 0
+            if out is None:
+                return line # type = 0
+            type = 0
         elif type == 3:
-            prev = [0]*len(line)
+            prev = array('B', [0])*len(line)
         elif type == 4: # "paeth"
-            type = 1
+            # The filter type byte remains 4.
+            out = filter_scanline(1, line, fo, None, out)
+            out[0] = 4
+            return out
+    elif not isarray(prev):
+        prev = array('B', prev)
+
+    # The output array, preallocated.
+    if out is None:
+        out = array('B', [0])*(len(line) + 1)
+    out[0] = type
+    # The filtered bytes of the first pixel, where there is no pixel to
+    # the left (a = c = 0), and those of the rest of the line, computed
+    # a whole line at a time.
+    izip = itertools.izip
     if type == 0:
-        out.extend(line)
-    elif type == 1:
-        sub()
-    elif type == 2:
-        up()
-    elif type == 3:
-        average()
-    else: # type == 4
-        paeth()
+        out[1:] = line
+        return out
+    elif type == 1: # "sub"
+        out[1:fo+1] = line[:fo]
+        rest = [(x - a) & 0xff for x,a in izip(line[fo:], line)]
+    elif type == 2: # "up"
+        out[1:] = array('B', [(x - b) & 0xff for x,b in izip(line, prev)])
+        return out
+    elif type == 3: # "average"
+        out[1:fo+1] = array('B',
+          [(x - (b >> 1)) & 0xff for x,b in izip(line[:fo], prev)])
+        rest = [(x - ((a + b) >> 1)) & 0xff
+                for x,a,b in izip(line[fo:], line, prev[fo:])]
+    else: # type == 4, "paeth"
+        # http://www.w3.org/TR/PNG/#9Filter-type-4-Paeth
+        # With a = c = 0 the predictor is b.
+        out[1:fo+1] = array('B',
+          [(x - b) & 0xff for x,b in izip(line[:fo], prev)])
+        rest = []
+        append = rest.append
+        for x,a,b,c in izip(line[fo:], line, prev[fo:], prev):
+            # For the predictor p = a + b - c, these are |p - a|,
+            # |p - b| and |p - c|.
+            pa = abs(b - c)
+            pb = abs(a - c)
+            pc = abs(a + b - c - c)
+            if pa <= pb and pa <= pc: x -= a
+            elif pb <= pc: x -= b
+            else: x -= c
+            append(x & 0xff)
+    out[fo+1:] = array('B', rest)
     return out
 
+def filter_band(type, data, start, rows, fo, prev=None):
+    """Filter a band of scanlines in place.  The band is `rows`
+    consecutive scanlines of the same (reduced) image, all the same
+    length, that occupy ``data[start:]``, an ``array('B')``; as in the
+    image data of a PNG each scanline is preceded by a filter type
+    byte.  `type` is the filter type (0 to 4) to use for every
+    scanline, or ``'adaptive'`` to choose, for each scanline, the type
+    whose filtered bytes have the smallest sum of absolute values (as
+    signed bytes).  `fo` is the filter offset, as for
+    :func:`filter_scanline`, and `prev` is the (unfiltered) scanline
+    that precedes the band, or ``None`` if the band starts the image.
+
+    Returns the last scanline of the band, unfiltered.
+    """
+
+    width = (len(data) - start) // rows - 1
+    if prev is None:
+        prev = array('B', [0])*width
+    if type == 'adaptive':
+        types = (0,1,2,3,4)
+    else:
+        types = (type,)
+    # One preallocated output row per filter type.
+    outs = [array('B', [0])*(width + 1) for t in types]
+    for i in range(start, len(data), width + 1):
+        line = data[i+1:i+width+1]
+        best = None
+        for t,out in zip(types, outs):
+            filter_scanline(t, line, fo, prev, out)
+            if len(types) == 1:
+                best = out
+                break
+            cost = sum(map(_filter_cost.__getitem__, out[1:]))
+            if best is None or cost < bestcost:
+                best, bestcost = out, cost
+            if cost == 0:
+                break
+        data[i:i+width+1] = best
+        prev = line
+    return prev
 
 def from_array(a, mode=None, info={}):
     """Create a PNG :class:`Image` object from a 2- or 3-dimensional array.
@@ -1305,12 +1718,199 @@ class _readable:
         self.offset += n
         return r
 
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.offset
+        elif whence == 2:
+            offset += len(self.buf)
+        self.offset = offset
+
+
+def probe(_guess=None, **kw):
+    """Return the metadata of a PNG image without decoding it, reading
+    only its signature and ``IHDR`` chunk (the first 33 bytes).  The
+    arguments are as for the :class:`Reader` constructor.
+
+    Returns (*width*, *height*, *metadata*), where *metadata* has the
+    same keys as the one returned by :meth:`Reader.read` (apart from
+    those that come from later chunks, such as ``gamma``), plus
+    ``colormap``.
+    """
+
+    r = Reader(_guess, **kw)
+    r.validate_signature()
+    r.atchunk = r.chunklentype()
+    if r.atchunk is None or r.atchunk[1] != 'IHDR':
+        raise FormatError('PNG file does not start with an IHDR chunk.')
+    r.process_chunk()
+    meta = dict()
+    for attr in 'greyscale alpha planes bitdepth interlace colormap'.split():
+        meta[attr] = getattr(r, attr)
+    meta['size'] = (r.width, r.height)
+    return r.width, r.height, meta
+
+
+def _filter_band_numpy(type, data, start, rows, fo, prev=None):
+    """Filter a band of scanlines in place using numpy.  The arguments
+    and the result are as for :func:`filter_band`, and the filtered
+    band is identical.
+
+    Filtering, unlike reconstruction, only depends on the unfiltered
+    bytes, so every filter is computed for the whole band at once; for
+    ``'adaptive'`` all five are, and each scanline picks its own.
+    """
+
+    width = (len(data) - start) // rows - 1
+    band = numpy.frombuffer(data, numpy.uint8)[start:].reshape(rows, -1)
+    # Current (x), left (a), above (b) and upper left (c) bytes.
+    x = band[:,1:].copy()
+    last = array('B', x[-1].tostring())
+    b = numpy.zeros_like(x)
+    if prev is not None:
+        b[0] = numpy.frombuffer(prev, numpy.uint8)
+    b[1:] = x[:-1]
+    a = numpy.zeros_like(x)
+    a[:,fo:] = x[:,:-fo]
+    c = numpy.zeros_like(x)
+    c[:,fo:] = b[:,:-fo]
+
+    def paeth():
+        # http://www.w3.org/TR/PNG/#9Filter-type-4-Paeth
+        a16, b16, c16 = [v.astype(numpy.int16) for v in (a, b, c)]
+        pa = numpy.abs(b16 - c16)
+        pb = numpy.abs(a16 - c16)
+        pc = numpy.abs(a16 + b16 - c16 - c16)
+        predictor = numpy.where((pa <= pb) & (pa <= pc), a,
+                                numpy.where(pb <= pc, b, c))
+        return x - predictor
+
+    filters = [lambda: x,
+               lambda: x - a,
+               lambda: x - b,
+               lambda: x - ((a.astype(numpy.uint16) + b) >> 1).astype(numpy.uint8),
+               paeth]
+    if type == 'adaptive':
+        candidates = numpy.array([f() for f in filters])
+        cost = numpy.array(_filter_cost, numpy.int32)[candidates].sum(axis=2)
+        choice = cost.argmin(axis=0)
+        band[:,0] = choice
+        band[:,1:] = candidates[choice, numpy.arange(rows)]
+    else:
+        band[:,0] = type
+        band[:,1:] = filters[type]()
+    return last
+
+def _undo_filter_numpy(filter_type, scanline, previous, fu, result=None):
+    """Undo the filter for a scanline using numpy.  The arguments are
+    as for :meth:`Reader.undo_filter` (except that `filter_type` must
+    already have been validated), `fu` being the filter unit.  The result is
+    identical to that of the pure Python code.
+
+    "None", "up" and "sub" are whole row operations ("sub" is a
+    cumulative sum down each byte column of the row, taken modulo 256).
+    "Average" and "Paeth" depend on the byte just reconstructed to their
+    left, so only the terms that depend on the previous line are
+    computed for the whole row; the rest remains a scalar loop.
+    """
+
+    def asbytes(seq):
+        """View a sequence of bytes as a numpy array (without copying
+        it, when it is an ``array``)."""
+        if isinstance(seq, array):
+            return numpy.frombuffer(seq, numpy.uint8)
+        return numpy.array(seq, numpy.uint8)
+
+    def finish(out):
+        """Return the reconstructed line `out` (any sequence of byte
+        values) as an ``array('B')``, in `result` when given."""
+        if result is None:
+            if isinstance(out, list):
+                return array('B', out)
+            return array('B', out.tostring())
+        numpy.frombuffer(result, numpy.uint8)[:] = out
+        return result
+
+    if not previous:
+        # With an all-zero previous line, "up" is the same as "none",
+        # and "Paeth" is the same as "sub".
+        if filter_type == 2:
+            filter_type = 0
+        elif filter_type == 4:
+            filter_type = 1
+
+    n = len(scanline)
+    line = asbytes(scanline)
+    if filter_type == 0:
+        return finish(line)
+    if filter_type == 1:
+        # Pad to a whole number of pixels so that each byte column of
+        # the line becomes a column of a 2D array.
+        columns = numpy.zeros(-(-n // fu) * fu, numpy.uint8)
+        columns[:n] = line
+        columns = columns.reshape(-1, fu).cumsum(axis=0, dtype=numpy.uint8)
+        return finish(columns.ravel()[:n])
+    if previous:
+        prior = asbytes(previous)
+    else:
+        prior = numpy.zeros(n, numpy.uint8)
+    if filter_type == 2:
+        return finish(line + prior)
+
+    xl = line.tolist()
+    bl = prior.tolist()
+    out = xl[:]
+    if filter_type == 3:
+        for i in range(min(fu, n)):
+            out[i] = (xl[i] + (bl[i] >> 1)) & 0xff
+        for i in range(fu, n):
+            out[i] = (xl[i] + ((out[i-fu] + bl[i]) >> 1)) & 0xff
+        return finish(out)
+
+    # Paeth.  For the predictor p = a + b - c, the distance pa = |p - a|
+    # is |b - c|, which only depends on the previous line.
+    upleft = numpy.zeros(n, numpy.int16)
+    upleft[fu:] = prior[:-fu]
+    cl = upleft.tolist()
+    pal = numpy.abs(prior.astype(numpy.int16) - upleft).tolist()
+    for i in range(min(fu, n)):
+        # a and c are 0, so the predictor is b.
+        out[i] = (xl[i] + bl[i]) & 0xff
+    for i in range(fu, n):
+        a = out[i-fu]
+        b = bl[i]
+        c = cl[i]
+        pa = pal[i]
+        pb = abs(a - c)
+        pc = abs(a + b - c - c)
+        if pa <= pb and pa <= pc:
+            pr = a
+        elif pb <= pc:
+            pr = b
+        else:
+            pr = c
+        out[i] = (xl[i] + pr) & 0xff
+    return finish(out)
+
 
 class Reader:
     """
     PNG decoder in pure Python.
     """
 
+    # Whether :meth:`undo_filter` uses numpy when it is available.  Set
+    # this to False (on the class or on an instance) to force the pure
+    # Python code.
+    use_numpy = True
+
+    # The most image data, in rows, that :meth:`read` decompresses in
+    # one go, however large the ``IDAT`` chunks are.
+    decompress_rows = 8
+
+    # A ceiling, in bytes, on the decompressed image data; when it is
+    # exceeded :meth:`read` raises :exc:`FormatError`.  None means the
+    # only limit is the size implied by the image header.
+    max_decompressed = None
+
     def __init__(self, _guess=None, **kw):
         """
         Create a PNG decoder object.
@@ -1406,6 +2006,54 @@ class Reader:
                   (type, a, b))
             return type, data
 
+    def chunk_index(self):
+        """Return a list with a (*type*, *offset*, *length*) tuple for
+        every chunk in the file, in file order.  *offset* is the
+        position in the file of the chunk's data, and *length* its
+        length.
+
+        Only the 8 bytes of length and type in front of each chunk are
+        read: chunk data and checksums are skipped, by seeking when the
+        input supports it (files and in-memory data do), otherwise by
+        reading and discarding them.  So chunk data is not checked.
+
+        This consumes the input; it must be called before any other
+        method reads from it.
+        """
+
+        if self.signature is not None:
+            raise Error("chunk_index() must be called before the PNG"
+                        " file has been read from.")
+        self.validate_signature()
+        index = []
+        offset = len(_signature)
+        while True:
+            lentype = self.chunklentype()
+            if lentype is None:
+                break
+            length,type = lentype
+            offset += 8
+            index.append((type, offset, length))
+            self.skip(length + 4)
+            offset += length + 4
+            if type == 'IEND':
+                break
+        return index
+
+    def skip(self, n):
+        """Skip `n` bytes of input, seeking past them if possible."""
+
+        try:
+            self.file.seek(n, 1)
+            return
+        except (AttributeError, IOError):
+            pass
+        while n > 0:
+            data = self.file.read(min(n, 2**16))
+            if not data:
+                break
+            n -= len(data)
+
     def chunks(self):
         """Return an iterator that will yield each chunk as a
         (*chunktype*, *content*) pair.
@@ -1417,7 +2065,78 @@ class Reader:
             if t == 'IEND':
                 break
 
-    def undo_filter(self, filter_type, scanline, previous):
+    def idat_size(self):
+        """Return the number of bytes that the decompressed ``IDAT``
+        data should have, given the image header: the filter type byte
+        and the scanline of every row (of every pass, for interlaced
+        images).
+        """
+
+        if not self.interlace:
+            return self.height * (self.row_bytes + 1)
+        size = 0
+        for xstart, ystart, xstep, ystep in _adam7:
+            if xstart >= self.width or ystart >= self.height:
+                continue
+            ppr = int(math.ceil((self.width-xstart)/float(xstep)))
+            row_size = int(math.ceil(self.psize * ppr))
+            rows = int(math.ceil((self.height-ystart)/float(ystep)))
+            size += rows * (row_size + 1)
+        return size
+
+    def value_mapper(self, key, bitdepth, f):
+        """Return a function that converts a row of samples of
+        `bitdepth` bits by applying `f` to every sample.  Rather than
+        calling `f` per sample, the function looks each sample up in a
+        table of `f` over all ``2**bitdepth`` possible values.  Tables
+        are built on first use and shared by all Readers, under `key`
+        (which must identify `f`) and `bitdepth`.  An image with fewer
+        samples than the table would have entries, that finds no table
+        built, has `f` applied to each sample instead.
+
+        Rows are returned as lists.  When every sample and every result
+        fits in a byte, they are converted in bulk with
+        ``str.translate``.
+        """
+
+        tables = _value_tables.get((key, bitdepth))
+        if tables is None:
+            if self.width * self.height * self.planes < 2**bitdepth:
+                return lambda row: map(f, row)
+            table = map(f, range(2**bitdepth))
+            bytelike = [v for v in table
+                        if isinstance(v, int) and 0 <= v <= 255]
+            trans = None
+            if bitdepth <= 8 and len(bytelike) == len(table):
+                trans = ''.join(map(chr, table))
+                trans += '\x00' * (256 - len(trans))
+            tables = _value_tables[(key, bitdepth)] = (table, trans)
+        table, trans = tables
+        if trans is not None:
+            def mapper(row):
+                if not isarray(row):
+                    row = array('B', row)
+                return array('B', tostring(row).translate(trans)).tolist()
+        else:
+            def mapper(row):
+                return map(table.__getitem__, row)
+        return mapper
+
+    def zero_row(self, n):
+        """Return an ``array('B')`` of `n` zero bytes, standing in for
+        the missing previous line of the first row in a pass.  The same
+        array is returned each time (for the same `n`), so it must not be
+        modified.
+        """
+
+        zeros = getattr(self, '_zeros', None)
+        if zeros is None or len(zeros) != n:
+            # Repeating a one-element array avoids building a temporary
+            # list of n zeros.
+            zeros = self._zeros = array('B', [0]) * n
+        return zeros
+
+    def undo_filter(self, filter_type, scanline, previous, result=None):
         """Undo the filter for a scanline.  `scanline` is a sequence of
         bytes that does not include the initial filter type byte.
         `previous` is decoded previous scanline (for straightlaced
@@ -1429,9 +2148,22 @@ class Reader:
         interlaced image), then this argument should be ``None``.
 
         The scanline will have the effects of filtering removed, and the
-        result will be returned as a fresh sequence of bytes.
+        result will be returned as a fresh sequence of bytes.  Unless
+        `result` is supplied: it should be an ``array('B')`` of the same
+        length as `scanline` (and distinct from both `scanline` and
+        `previous`), and is filled with the result and returned in place
+        of a fresh sequence.
+
+        When numpy is available (and :attr:`use_numpy` is true), the
+        work is done by a numpy implementation that gives identical
+        results.
         """
 
+        if (self.use_numpy and numpy is not None and
+          filter_type in (0,1,2,3,4)):
+            return _undo_filter_numpy(filter_type, scanline, previous,
+                                      max(1, self.psize), result)
+
         # :todo: Would it be better to update scanline in place?
 
         # Create the result byte array.  It seems that the best way to
@@ -1439,7 +2171,10 @@ class Reader:
         # existing sequence.  *sigh*
         # If we fill the result with scanline, then this allows a
         # micro-optimisation in the "null" and "sub" cases.
-        result = array('B', scanline)
+        if result is None:
+            result = array('B', scanline)
+        else:
+            result[:] = scanline
 
         if filter_type == 0:
             # And here, we _rely_ on filling the result with scanline,
@@ -1461,7 +2196,7 @@ class Reader:
         # first line 'up' is the same as 'null', 'paeth' is the same
         # as 'sub', with only 'average' requiring any special case.
         if not previous:
-            previous = array('B', [0]*len(scanline))
+            previous = self.zero_row(len(scanline))
 
         def sub():
             """Undo sub filter."""
@@ -1533,6 +2268,10 @@ class Reader:
         """
         Read raw pixel data, undo filters, deinterlace, and flatten.
         Return in flat row flat pixel format.
+
+        `raw` is either an ``array`` of all the decompressed data, or
+        an iterable that yields it in blocks of arbitrary size; the
+        blocks are consumed pass by pass, as they are needed.
         """
 
         # print >> sys.stderr, ("Reading interlaced, w=%s, r=%s, planes=%s," +
@@ -1544,7 +2283,14 @@ class Reader:
         # writes to the output array randomly (well, not quite), so the
         # entire output array must be in memory.
         fmt = 'BH'[self.bitdepth > 8]
-        a = array(fmt, [0]*vpr*self.height)
+        a = array(fmt, [0]) * (vpr * self.height)
+
+        if isarray(raw):
+            raw = [raw]
+        blocks = iter(raw)
+        # The block of decompressed data being consumed, and the offset
+        # of the next row in it.
+        source = array('B')
         source_offset = 0
 
         for xstart, ystart, xstep, ystep in _adam7:
@@ -1560,22 +2306,37 @@ class Reader:
             ppr = int(math.ceil((self.width-xstart)/float(xstep)))
             # Row size in bytes for this pass.
             row_size = int(math.ceil(self.psize * ppr))
+            # Each row is copied into the result straight away, so the
+            # pass can be decoded into two row buffers used in turn (see
+            # :meth:`iterstraight`).
+            buffers = (array('B', [0]) * row_size,
+                       array('B', [0]) * row_size)
+            # Stride between the pixels of the pass in a target row.
+            skip = self.planes * xstep
             for y in range(ystart, self.height, ystep):
-                filter_type = raw[source_offset]
-                source_offset += 1
-                scanline = raw[source_offset:source_offset+row_size]
-                source_offset += row_size
-                recon = self.undo_filter(filter_type, scanline, recon)
+                while len(source) - source_offset < row_size + 1:
+                    try:
+                        more = blocks.next()
+                    except StopIteration:
+                        raise FormatError(
+                          'Wrong size for decompressed IDAT chunk.')
+                    del source[:source_offset]
+                    source_offset = 0
+                    source.extend(more)
+                filter_type = source[source_offset]
+                scanline = source[source_offset+1:source_offset+row_size+1]
+                source_offset += row_size + 1
+                out = buffers[recon is buffers[0]]
+                recon = self.undo_filter(filter_type, scanline, recon, out)
                 # Convert so that there is one element per pixel value
                 flat = self.serialtoflat(recon, ppr)
+                offset = y * vpr
                 if xstep == 1:
                     assert xstart == 0
-                    offset = y * vpr
                     a[offset:offset+vpr] = flat
                 else:
-                    offset = y * vpr + xstart * self.planes
+                    offset += xstart * self.planes
                     end_offset = (y+1) * vpr
-                    skip = self.planes * xstep
                     for i in range(self.planes):
                         a[offset+i:end_offset:skip] = \
                             flat[i::self.planes]
@@ -1594,18 +2355,10 @@ class Reader:
             if self.bitdepth == 8:
                 return raw
             if self.bitdepth == 16:
-                raw = tostring(raw)
-                return array('H', struct.unpack('!%dH' % (len(raw)//2), raw))
+                return unpack_uint16(raw)
             assert self.bitdepth < 8
-            width = self.width
-            # Samples per byte
-            spb = 8//self.bitdepth
-            out = array('B')
-            mask = 2**self.bitdepth - 1
-            shifts = map(self.bitdepth.__mul__, reversed(range(spb)))
-            for o in raw:
-                out.extend(map(lambda i: mask&(o>>i), shifts))
-            return out[:width]
+            table = unpack_table(self.bitdepth)
+            return array('B', ''.join(map(table.__getitem__, raw))[:self.width])
 
         return itertools.imap(asvalues, rows)
 
@@ -1617,30 +2370,35 @@ class Reader:
         if self.bitdepth == 8:
             return bytes
         if self.bitdepth == 16:
-            bytes = tostring(bytes)
-            return array('H',
-              struct.unpack('!%dH' % (len(bytes)//2), bytes))
+            return unpack_uint16(bytes)
         assert self.bitdepth < 8
         if width is None:
             width = self.width
         # Samples per byte
         spb = 8//self.bitdepth
+        table = unpack_table(self.bitdepth)
+        samples = ''.join(map(table.__getitem__, bytes))
+        # Each row is padded to a whole number of bytes; drop the
+        # padding samples from the end of every row.
+        padded = -(-width // spb) * spb
+        if padded == width:
+            return array('B', samples)
         out = array('B')
-        mask = 2**self.bitdepth - 1
-        shifts = map(self.bitdepth.__mul__, reversed(range(spb)))
-        l = width
-        for o in bytes:
-            out.extend(map(lambda i: mask&(o>>i), shifts)[:l])
-            l -= spb
-            if l <= 0:
-                l = width
+        for i in range(0, len(samples), padded):
+            out.extend(array('B', samples[i:i+width]))
         return out
 
-    def iterstraight(self, raw):
+    def iterstraight(self, raw, reuse_rows=False):
         """Iterator that undoes the effect of filtering, and yields each
         row in serialised format (as a sequence of bytes).  Assumes input
         is straightlaced.  `raw` should be an iterable that yields the
-        raw bytes in chunks of arbitrary size."""
+        raw bytes in chunks of arbitrary size.
+
+        If `reuse_rows` is true, then rather than a fresh array for each
+        row, two row buffers are used in turn: each row yielded is only
+        valid until the next one is requested (and must not be modified,
+        because it is the previous line for the next row).
+        """
 
         # length of row, in bytes
         rb = self.row_bytes
@@ -1648,14 +2406,28 @@ class Reader:
         # The previous (reconstructed) scanline.  None indicates first
         # line of image.
         recon = None
+        # The row buffers, when reused.  Each row is decoded into the
+        # one that does not hold recon.
+        buffers = None
+        if reuse_rows:
+            buffers = (array('B', [0]) * rb, array('B', [0]) * rb)
+        out = None
         for some in raw:
             a.extend(some)
-            while len(a) >= rb + 1:
-                filter_type = a[0]
-                scanline = a[1:rb+1]
-                del a[:rb+1]
-                recon = self.undo_filter(filter_type, scanline, recon)
+            # Walk the rows in the buffer with an advancing offset, and
+            # discard the consumed bytes once per block; deleting each
+            # row as it is consumed would shift the rest of the buffer
+            # every time, making large blocks quadratic to decode.
+            offset = 0
+            while len(a) - offset >= rb + 1:
+                filter_type = a[offset]
+                scanline = a[offset+1:offset+rb+1]
+                offset += rb + 1
+                if buffers:
+                    out = buffers[recon is buffers[0]]
+                recon = self.undo_filter(filter_type, scanline, recon, out)
                 yield recon
+            del a[:offset]
         if len(a) != 0:
             # :file:format We get here with a file format error: when the
             # available bytes (after decompressing) do not pack into exact
@@ -1834,7 +2606,7 @@ class Reader:
                 not self.colormap and len(data) != self.planes):
                 raise FormatError("sBIT chunk has incorrect length.")
 
-    def read(self):
+    def read(self, reuse_rows=False):
         """
         Read the PNG file and decode it.  Returns (`width`, `height`,
         `pixels`, `metadata`).
@@ -1842,6 +2614,12 @@ class Reader:
         May use excessive memory.
 
         `pixels` are returned in boxed row flat pixel format.
+
+        If `reuse_rows` is true, then for straightlaced images rows are
+        decoded into buffers that are reused: each row is only valid
+        until the next one is requested, so callers that keep rows must
+        copy them.  This saves allocating a new array for every row, and
+        suits callers that consume each row straight away.
         """
 
         def iteridat():
@@ -1865,36 +2643,58 @@ class Reader:
         def iterdecomp(idat):
             """Iterator that yields decompressed strings.  `idat` should
             be an iterator that yields the ``IDAT`` chunk data.
+
+            Each string is at most :attr:`decompress_rows` rows' worth
+            of bytes, and :exc:`FormatError` is raised as soon as the
+            data inflates to more than the image can hold (or to more
+            than :attr:`max_decompressed` bytes).
             """
 
-            # Currently, with no max_length paramter to decompress, this
-            # routine will do one yield per IDAT chunk.  So not very
-            # incremental.
+            size = self.idat_size()
+            ceiling = self.max_decompressed
+            max_length = max(1, self.decompress_rows) * (self.row_bytes + 1)
+            total = 0
             d = zlib.decompressobj()
             # The decompression loop:
-            # Decompress an IDAT chunk, then decompress any remaining
-            # unused data until the unused data does not get any
-            # smaller.  Add the unused data to the front of the input
-            # and loop to process the next IDAT chunk.
-            cdata = ''
+            # Decompress no more than max_length bytes of an IDAT chunk,
+            # then carry on with the unconsumed tail of the input until
+            # it is all used up.  Output can still be pending when the
+            # input is used up and max_length bytes were produced, so
+            # carry on until a call produces less than that.
             for data in idat:
-                # :todo: add a max_length argument here to limit output
-                # size.
-                yield array('B', d.decompress(cdata + data))
-            yield array('B', d.flush())
+                while True:
+                    out = d.decompress(data, max_length)
+                    data = d.unconsumed_tail
+                    total += len(out)
+                    if ceiling is not None and total > ceiling:
+                        raise FormatError(
+                          'Decompressed image data exceeds %d bytes.' %
+                          ceiling)
+                    if total > size:
+                        raise FormatError(
+                          'Wrong size for decompressed IDAT chunk.')
+                    if out:
+                        yield array('B', out)
+                    if not data and len(out) < max_length:
+                        break
+            out = d.flush()
+            if total + len(out) > size:
+                raise FormatError(
+                  'Wrong size for decompressed IDAT chunk.')
+            yield array('B', out)
 
         self.preamble()
         raw = iterdecomp(iteridat())
 
         if self.interlace:
-            raw = array('B', itertools.chain(*raw))
-            arraycode = 'BH'[self.bitdepth>8]
+            values = self.deinterlace(raw)
+            vpr = self.width * self.planes
             # Like :meth:`group` but producing an array.array object for
             # each row.
-            pixels = itertools.imap(lambda *row: array(arraycode, row),
-                       *[iter(self.deinterlace(raw))]*self.width*self.planes)
+            pixels = itertools.imap(lambda i: values[i:i+vpr],
+                                    range(0, len(values), vpr))
         else:
-            pixels = self.iterboxed(self.iterstraight(raw))
+            pixels = self.iterboxed(self.iterstraight(raw, reuse_rows))
         meta = dict()
         for attr in 'greyscale alpha planes bitdepth interlace'.split():
             meta[attr] = getattr(self, attr)
@@ -1906,23 +2706,49 @@ class Reader:
         return self.width, self.height, pixels, meta
 
 
-    def read_flat(self):
+    def read_flat(self, out=None):
         """
         Read a PNG file and decode it into flat row flat pixel format.
         Returns (*width*, *height*, *pixels*, *metadata*).
 
         May use excessive memory.
 
-        `pixels` are returned in flat row flat pixel format.
+        `pixels` are returned in flat row flat pixel format: an
+        ``array`` of ``width*height*planes`` values (typecode ``'B'``,
+        or ``'H'`` for bit depths above 8) which is allocated once, with
+        each row copied into its slice as it is decoded.
+
+        If `out` is supplied, the pixels are decoded into it instead
+        and it is returned as *pixels*.  It must have exactly
+        ``width*height*planes`` elements, and its slices must be
+        assignable from an ``array`` of the typecode given above (it
+        can be such an ``array``, or a numpy array).  This allows
+        repeated decodes of same-sized images to reuse one buffer.
 
         See also the :meth:`read` method which returns pixels in the
         more stream-friendly boxed row flat pixel format.
         """
 
-        x, y, pixel, meta = self.read()
+        x, y, pixel, meta = self.read(reuse_rows=True)
         arraycode = 'BH'[meta['bitdepth']>8]
-        pixel = array(arraycode, itertools.chain(*pixel))
-        return x, y, pixel, meta
+        # Values per row.
+        vpr = x * meta['planes']
+        if out is None:
+            out = array(arraycode, [0]) * (vpr * y)
+        else:
+            if len(out) != vpr * y:
+                raise ValueError(
+                  "buffer has %d elements, image needs %d" %
+                  (len(out), vpr * y))
+            if getattr(out, 'typecode', arraycode) != arraycode:
+                raise ValueError(
+                  "buffer has typecode %r, image needs %r" %
+                  (out.typecode, arraycode))
+        offset = 0
+        for row in pixel:
+            out[offset:offset+vpr] = row
+            offset += vpr
+        return x, y, out, meta
 
     def palette(self, alpha='natural'):
         """Returns a palette that is a sequence of 3-tuples or 4-tuples,
@@ -1947,7 +2773,7 @@ class Reader:
             plte = map(operator.add, plte, group(trns, 1))
         return plte
 
-    def asDirect(self):
+    def asDirect(self, reuse_rows=False):
         """Returns the image data as a direct representation of an
         ``x * y * planes`` array.  This method is intended to remove the
         need for callers to deal with palettes and transparency
@@ -1983,15 +2809,18 @@ class Reader:
         like the :meth:`read` method).
 
         All the other aspects of the image data are not changed.
+
+        `reuse_rows` is passed on to the :meth:`read` method; the
+        same caveat applies to the rows returned.
         """
 
         self.preamble()
 
         # Simple case, no conversion necessary.
         if not self.colormap and not self.trns and not self.sbit:
-            return self.read()
+            return self.read(reuse_rows)
 
-        x,y,pixels,meta = self.read()
+        x,y,pixels,meta = self.read(reuse_rows)
 
         if self.colormap:
             meta['colormap'] = False
@@ -2045,10 +2874,9 @@ class Reader:
         if targetbitdepth:
             shift = meta['bitdepth'] - targetbitdepth
             meta['bitdepth'] = targetbitdepth
-            def itershift(pixels):
-                for row in pixels:
-                    yield map(shift.__rrshift__, row)
-            pixels = itershift(pixels)
+            mapper = self.value_mapper(('shift', shift), shift + targetbitdepth,
+                                       shift.__rrshift__)
+            pixels = itertools.imap(mapper, pixels)
         return x,y,pixels,meta
 
     def asFloat(self, maxval=1.0):
@@ -2058,27 +2886,27 @@ class Reader:
         """
 
         x,y,pixels,info = self.asDirect()
-        sourcemaxval = 2**info['bitdepth']-1
+        bitdepth = info['bitdepth']
+        sourcemaxval = 2**bitdepth-1
         del info['bitdepth']
         info['maxval'] = float(maxval)
         factor = float(maxval)/float(sourcemaxval)
-        def iterfloat():
-            for row in pixels:
-                yield map(factor.__mul__, row)
-        return x,y,iterfloat(),info
+        mapper = self.value_mapper(('float', maxval), bitdepth,
+                                   factor.__mul__)
+        return x,y,itertools.imap(mapper, pixels),info
 
     def _as_rescale(self, get, targetbitdepth):
         """Helper used by :meth:`asRGB8` and :meth:`asRGBA8`."""
 
         width,height,pixels,meta = get()
-        maxval = 2**meta['bitdepth'] - 1
+        bitdepth = meta['bitdepth']
+        maxval = 2**bitdepth - 1
         targetmaxval = 2**targetbitdepth - 1
         factor = float(targetmaxval) / float(maxval)
         meta['bitdepth'] = targetbitdepth
-        def iterscale():
-            for row in pixels:
-                yield map(lambda x: int(round(x*factor)), row)
-        return width, height, iterscale(), meta
+        mapper = self.value_mapper(('rescale', targetbitdepth), bitdepth,
+                                   lambda x: int(round(x*factor)))
+        return width, height, itertools.imap(mapper, pixels), meta
 
     def asRGB8(self):
 	"""Return the image data as an RGB pixels with 8-bits per
@@ -2432,6 +3260,16 @@ class Test(unittest.TestCase):
         # In particular it should be #7f7f7f00
         row0 = list(pixels)[0]
         self.assertEqual(tuple(row0[0:4]), (0x7f, 0x7f, 0x7f, 0x00))
+    def testAdam7PngSuite(self):
+        """Test that the interlaced PngSuite images decode the same as
+        their straightlaced counterparts."""
+        for name in _pngsuite:
+            straightname = 'basn' + name[4:]
+            if not name.startswith('basi') or straightname not in _pngsuite:
+                continue
+            interlaced = Reader(bytes=_pngsuite[name]).read_flat()[2]
+            straight = Reader(bytes=_pngsuite[straightname]).read_flat()[2]
+            self.assertEqual(interlaced, straight)
     def testAdam7read(self):
         """Adam7 interlace reading.
         Specifically, test that for images in the PngSuite that
@@ -2640,6 +3478,322 @@ class Test(unittest.TestCase):
             data = data.encode('zip')
             return (chunk[0], data)
         self.assertRaises(FormatError, self.helperFormat, eachchunk)
+    def testDecompressionBomb(self):
+        """Test IDAT data that inflates to far more than the image
+        holds."""
+        def eachchunk(chunk):
+            if chunk[0] != 'IDAT':
+                return chunk
+            return (chunk[0], zlib.compress('\x00' * (16 << 20)))
+        self.assertRaises(FormatError, self.helperFormat, eachchunk)
+    def testMaxDecompressed(self):
+        r = Reader(bytes=_pngsuite['basn0g08'])
+        r.max_decompressed = 1000
+        self.assertRaises(FormatError, lambda: list(r.read()[2]))
+        # Exactly enough for 32 rows of 1 + 32 bytes, decompressed one
+        # row at a time.
+        r = Reader(bytes=_pngsuite['basn0g08'])
+        r.max_decompressed = 32 * 33
+        r.decompress_rows = 1
+        self.assertEqual(len(list(r.read()[2])), 32)
+    def testIterstraightBlocks(self):
+        """Test that rows are reassembled the same whatever the size of
+        the decompressed blocks, including blocks that split rows."""
+        r = Reader(bytes=_pngsuite['basn0g08'])
+        r.preamble()
+        raw = array('B', zlib.decompress(''.join(
+          [data for type, data in r.chunks() if type == 'IDAT'])))
+        expected = map(list, r.iterstraight([raw]))
+        for n in (1, 7, r.row_bytes + 1, 3 * r.row_bytes + 2):
+            blocks = [raw[i:i+n] for i in range(0, len(raw), n)]
+            self.assertEqual(map(list, r.iterstraight(blocks)), expected)
+    def helperUndoFilterBackends(self, name):
+        """Decode a PngSuite image with the pure Python and the numpy
+        implementations of undo_filter, and check they agree."""
+        results = []
+        for use_numpy in (False, True):
+            r = Reader(bytes=_pngsuite[name])
+            r.use_numpy = use_numpy
+            x,y,pixels,meta = r.read_flat()
+            results.append(list(pixels))
+        self.assertEqual(results[0], results[1])
+    def testUndoFilterBackends(self):
+        """Test the numpy undo_filter against all of the PngSuite."""
+        if numpy is None:
+            print >>sys.stderr, "skipping numpy test"
+            return
+        for name in _pngsuite:
+            self.helperUndoFilterBackends(name)
+    def testUndoFilterNumpy(self):
+        """Test the numpy undo_filter on every filter type, for all
+        filter units, with and without a previous line."""
+        if numpy is None:
+            print >>sys.stderr, "skipping numpy test"
+            return
+        import random
+        rng = random.Random(7)
+        r = Reader(bytes=_pngsuite['basn0g08'])
+        for fu in range(1, 9):
+            r.psize = fu
+            line = array('B', [rng.randrange(256) for i in range(5*fu+3)])
+            prev = array('B', [rng.randrange(256) for i in range(len(line))])
+            for filter_type in range(5):
+                for previous in (None, prev):
+                    r.use_numpy = False
+                    expected = r.undo_filter(filter_type, line, previous)
+                    r.use_numpy = True
+                    got = r.undo_filter(filter_type, line, previous)
+                    self.assertEqual(got, expected)
+    def testReuseRows(self):
+        """Test decoding into reused row buffers."""
+        for name in ('basn0g08', 'basn2c16', 'basn0g02', 'tbrn2c08'):
+            expected = map(list, Reader(bytes=_pngsuite[name]).asDirect()[2])
+            got = []
+            rows = Reader(bytes=_pngsuite[name]).asDirect(reuse_rows=True)[2]
+            for row in rows:
+                got.append(list(row))
+            self.assertEqual(got, expected)
+    def testSerialToFlat(self):
+        """Test unpacking of several rows of sub-byte samples, each
+        padded to a whole byte."""
+        r = Reader(bytes=_pngsuite['basn0g02'])
+        r.preamble()
+        # Two rows of 5 2-bit samples: 0 1 2 3 0 | 3 2 1 0 3.
+        flat = r.serialtoflat(array('B', [0x1b, 0x00, 0xe4, 0xc0]), 5)
+        self.assertEqual(list(flat), [0,1,2,3,0, 3,2,1,0,3])
+    def testUint16(self):
+        """Test 16-bit conversion to and from network order."""
+        values = array('H', [0, 1, 0x1234, 0xfedc, 0xffff])
+        bytes = '\x00\x00\x00\x01\x12\x34\xfe\xdc\xff\xff'
+        self.assertEqual(pack_uint16(values), bytes)
+        self.assertEqual(pack_uint16(list(values)), bytes)
+        self.assertEqual(values[2], 0x1234)
+        self.assertEqual(unpack_uint16(bytes), values)
+        self.assertEqual(unpack_uint16(array('B', bytes)), values)
+    def testValueMapper(self):
+        """Test the table-driven sample conversions against direct
+        computation."""
+        r = Reader(bytes=_pngsuite['basn0g08'])
+        x,y,pixels,meta = r.read()
+        pixels = list(pixels)
+        floats = list(Reader(bytes=_pngsuite['basn0g08']).asFloat(2.0)[2])
+        for row,floatrow in zip(pixels, floats):
+            self.assertEqual(floatrow, [v * (2.0/255) for v in row])
+        self.assert_((('float', 2.0), 8) in _value_tables)
+        x,y,rgb8,meta = Reader(bytes=_pngsuite['basn0g04']).asRGB8()
+        x,y,direct,meta = Reader(bytes=_pngsuite['basn0g04']).asRGB()
+        for row,directrow in zip(rgb8, direct):
+            self.assertEqual(list(row), [v * 17 for v in directrow])
+        x,y,rgb8,meta = Reader(bytes=_pngsuite['basn0g16']).asRGB8()
+        x,y,direct,meta = Reader(bytes=_pngsuite['basn0g16']).asRGB()
+        for row,directrow in zip(rgb8, direct):
+            self.assertEqual(list(row),
+              [int(round(v * 255.0 / 65535)) for v in directrow])
+    def testChunkIndex(self):
+        """Test the chunk index against the chunks as read."""
+        data = _pngsuite['tbbn1g04']
+        chunks = list(Reader(bytes=data).chunks())
+        for r in (Reader(bytes=data), Reader(file=StringIO(data))):
+            index = r.chunk_index()
+            self.assertEqual(len(index), len(chunks))
+            for (type,offset,length),(ctype,content) in zip(index, chunks):
+                self.assertEqual(type, ctype)
+                self.assertEqual(data[offset:offset+length], content)
+    def testProbe(self):
+        """Test probe, and that it reads no further than IHDR."""
+        class countingfile:
+            def __init__(self, data):
+                self.file = StringIO(data)
+                self.count = 0
+            def read(self, n):
+                r = self.file.read(n)
+                self.count += len(r)
+                return r
+        f = countingfile(_pngsuite['basi3p08'])
+        x,y,meta = probe(file=f)
+        self.assertEqual((x, y), (32, 32))
+        self.assertEqual(meta['colormap'], True)
+        self.assertEqual(meta['interlace'], 1)
+        self.assertEqual(meta['bitdepth'], 8)
+        self.assertEqual(f.count, 33)
+        self.assertRaises(FormatError, probe, bytes='not a PNG file')
+    def testFilterTypes(self):
+        """Test writing with each filter type, and adaptively."""
+        pixels = array('B', test_rgba(19, 8, 'RCTR', 'CK8', 'GLR'))
+        for interlace in (False, True):
+            sizes = {}
+            for filter_type in (0,1,2,3,4,'adaptive'):
+                o = StringIO()
+                w = Writer(19, 19, interlace=interlace,
+                           filter_type=filter_type)
+                w.write_array(o, pixels)
+                sizes[filter_type] = len(o.getvalue())
+                x,y,flat,meta = Reader(bytes=o.getvalue()).read_flat()
+                self.assertEqual(flat, pixels)
+            self.assert_(sizes['adaptive'] < sizes[0])
+        for bitdepth in (2, 16):
+            o = StringIO()
+            w = Writer(5, 9, greyscale=True, bitdepth=bitdepth,
+                       interlace=True, filter_type='adaptive')
+            values = array('BH'[bitdepth > 8],
+                           [(i * 41) % 2**bitdepth for i in range(45)])
+            w.write_array(o, values)
+            self.assertEqual(Reader(bytes=o.getvalue()).read_flat()[2],
+                             values)
+        self.assertRaises(ValueError, Writer, 1, 1, filter_type=5)
+    def testFilterScanline(self):
+        """Test filter_scanline against the filters as defined, and
+        filter_band against filter_scanline."""
+        def paeth(a, b, c):
+            p = a + b - c
+            pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+            if pa <= pb and pa <= pc: return a
+            elif pb <= pc: return b
+            return c
+        predictors = [lambda a,b,c: 0, lambda a,b,c: a,
+                      lambda a,b,c: b, lambda a,b,c: (a + b) >> 1, paeth]
+        line = array('B', [(i * 73 + 40) % 256 for i in range(23)])
+        prev = array('B', [(i * 151) % 256 for i in range(23)])
+        for fo in (1, 2, 3, 4, 6):
+            for type in range(5):
+                expect = [type]
+                for i,x in enumerate(line):
+                    a = c = 0
+                    if i >= fo:
+                        a, c = line[i-fo], prev[i-fo]
+                    expect.append((x - predictors[type](a, prev[i], c)) & 0xff)
+                self.assertEqual(list(filter_scanline(type, line, fo, prev)),
+                                 expect)
+                out = array('B', [9])*24
+                self.assert_(filter_scanline(type, line, fo, prev, out) is out)
+                self.assertEqual(list(out), expect)
+        # Without a previous line.
+        self.assertEqual(filter_scanline(2, line, 3), line)
+        self.assertEqual(filter_scanline(4, line, 3)[1:],
+                         filter_scanline(1, line, 3)[1:])
+
+        # Bands, in pure Python and (if available) numpy.
+        fo = 3
+        lines = [array('B', [(i * j * 29 + j) % 256 for i in range(12)])
+                 for j in range(7)]
+        for type in (0,1,2,3,4,'adaptive'):
+            for prev in (None, lines[0]):
+                expect = array('B')
+                p = prev
+                for line in lines[1:]:
+                    if type == 'adaptive':
+                        candidates = [filter_scanline(t, line, fo,
+                                        p or array('B', [0])*12)
+                                      for t in range(5)]
+                        costs = [sum(map(_filter_cost.__getitem__, f[1:]))
+                                 for f in candidates]
+                        expect.extend(candidates[costs.index(min(costs))])
+                    else:
+                        expect.extend(filter_scanline(type, line, fo,
+                                        p or array('B', [0])*12))
+                    p = line
+                fs = [filter_band]
+                if numpy:
+                    fs.append(_filter_band_numpy)
+                for f in fs:
+                    data = array('B', [255, 255])
+                    for line in lines[1:]:
+                        data.append(0)
+                        data.extend(line)
+                    last = f(type, data, 2, 6, fo, prev)
+                    self.assertEqual(data[2:], expect)
+                    self.assertEqual(data[:2], array('B', [255, 255]))
+                    self.assertEqual(last, lines[-1])
+    def testAdler32Combine(self):
+        """Test adler32_combine."""
+        for a,b in [('', ''), ('PNG', ''), ('', 'IDAT'),
+                    ('image', 'data'), ('\xff' * 6000, '\xfe' * 70000)]:
+            self.assertEqual(adler32_combine(zlib.adler32(a) & 0xffffffff,
+                                             zlib.adler32(b) & 0xffffffff,
+                                             len(b)),
+                             zlib.adler32(a + b) & 0xffffffff)
+    def testThreads(self):
+        """Test compressing on several threads."""
+        def idat(png):
+            r = Reader(bytes=png)
+            return ''.join([d for t,d in r.chunks() if t == 'IDAT'])
+        pixels = array('B', test_rgba(300, 8, 'GTB', 'GLR', 'RTL'))
+        for interlace in (False, True):
+            o = StringIO()
+            Writer(300, 300, interlace=interlace,
+                   filter_type=1).write_array(o, pixels)
+            single = zlib.decompress(idat(o.getvalue()))
+            for threads in (2, 5):
+                o = StringIO()
+                Writer(300, 300, interlace=interlace, filter_type=1,
+                       threads=threads).write_array(o, pixels)
+                self.assertEqual(zlib.decompress(idat(o.getvalue())),
+                                 single)
+                self.assertEqual(Reader(bytes=o.getvalue()).read_flat()[2],
+                                 pixels)
+                # The chunking does not depend on thread timing.
+                for i in range(3):
+                    again = StringIO()
+                    Writer(300, 300, interlace=interlace, filter_type=1,
+                           threads=threads).write_array(again, pixels)
+                    self.assertEqual(again.getvalue(), o.getvalue())
+        # An image smaller than a band.
+        o = StringIO()
+        Writer(3, 2, greyscale=True, threads=4).write_array(o, range(6))
+        self.assertEqual(list(Reader(bytes=o.getvalue()).read_flat()[2]),
+                         range(6))
+    def testPackSamples(self):
+        """Test pack_samples, and writing packed rows."""
+        for bitdepth in (1, 2, 4):
+            spb = 8 // bitdepth
+            for n in (1, 7, 8, 9, 31):
+                values = [(i * 5 + n) % 2**bitdepth for i in range(n)]
+                padded = values + [0] * (-n % spb)
+                expect = [reduce(lambda x,y: (x << bitdepth) + y,
+                                 padded[i:i+spb])
+                          for i in range(0, len(padded), spb)]
+                self.assertEqual(map(ord, pack_samples(values, bitdepth)),
+                                 expect)
+                self.assertEqual(pack_samples(array('B', values), bitdepth),
+                                 pack_samples(values, bitdepth))
+        self.assertRaises(ValueError, pack_samples, [2], 1)
+        rows = [[1,0,0,1,1,1,0,0,1,1], [0]*10, [1]*10]
+        o = StringIO()
+        Writer(10, 3, greyscale=True, bitdepth=1).write_packed(o,
+          [pack_samples(row, 1) for row in rows])
+        self.assertEqual(map(list, Reader(bytes=o.getvalue()).read()[2]),
+                         rows)
+    def testStream(self):
+        """Test generating a PNG in pieces."""
+        rows = [[0,1,2], [3,4,5], [6,7,8], [9,10,11]]
+        for interlace in (False, True):
+            w = Writer(3, 4, greyscale=True, interlace=interlace,
+                       chunk_limit=5)
+            o = StringIO()
+            w.write(o, rows)
+            pieces = list(w.stream(rows))
+            self.assertEqual(''.join(pieces), o.getvalue())
+            self.assertEqual(pieces[0], _signature)
+            self.assertEqual(pieces[-1], chunk_bytes('IEND'))
+            self.assert_(len(pieces) > 4)
+        # Pieces are generated as the rows are consumed.
+        used = []
+        def generate():
+            for row in rows:
+                used.append(row)
+                yield row
+        pieces = Writer(3, 4, greyscale=True, chunk_limit=5).stream(generate())
+        pieces.next()
+        pieces.next()
+        self.assertEqual(used, [])
+        pieces.next()
+        self.assert_(0 < len(used) < 4)
+        self.assertRaises(ValueError, list,
+                          Writer(3, 5, greyscale=True).stream(rows))
+        # No rows at all.
+        w = Writer(3, 4, greyscale=True)
+        self.assertRaises(ValueError, w.write_passes, StringIO(), iter([]))
+        self.assertRaises(ValueError, list, w.stream_passes(iter([])))
     def testFlat(self):
         """Test read_flat."""
         import hashlib
@@ -2648,6 +3802,19 @@ class Test(unittest.TestCase):
         x,y,pixel,meta = r.read_flat()
         d = hashlib.md5(''.join(map(chr, pixel))).digest()
         self.assertEqual(d.encode('hex'), '255cd971ab8cd9e7275ff906e5041aa0')
+    def testFlatBuffer(self):
+        """Test read_flat into a supplied buffer."""
+        for name in ('basn2c08', 'basi0g16', 'basn0g01'):
+            x,y,expected,meta = Reader(bytes=_pngsuite[name]).read()
+            expected = list(itertools.chain(*expected))
+            arraycode = 'BH'[meta['bitdepth']>8]
+            buf = array(arraycode, [0]) * len(expected)
+            for i in range(2):
+                pixels = Reader(bytes=_pngsuite[name]).read_flat(buf)[2]
+                self.assert_(pixels is buf)
+                self.assertEqual(list(buf), expected)
+        r = Reader(bytes=_pngsuite['basn0g08'])
+        self.assertRaises(ValueError, r.read_flat, array('B', [0]) * 10)
     def testfromarray(self):
         img = from_array([[0, 0x33, 0x66], [0xff, 0xcc, 0x99]], 'L')
         img.save('testfromarray.png')
@@ -3234,99 +4401,101 @@ acf0c6211c036f14a239703741740adc7da227edd7e56b833d0ae92549b4d357
 """),
 }
 
-def test_suite(options, args):
-    """
-    Create a PNG test image and write the file to stdout.
+# Below is a big stack of test image generators.  They are used by
+# test_suite() and are also handy for generating synthetic images
+# elsewhere (benchmarks, for example).
+# They're all really tiny, so PEP 8 rules are suspended.
+
+def test_gradient_horizontal_lr(x, y): return x
+def test_gradient_horizontal_rl(x, y): return 1-x
+def test_gradient_vertical_tb(x, y): return y
+def test_gradient_vertical_bt(x, y): return 1-y
+def test_radial_tl(x, y): return max(1-math.sqrt(x*x+y*y), 0.0)
+def test_radial_center(x, y): return test_radial_tl(x-0.5, y-0.5)
+def test_radial_tr(x, y): return test_radial_tl(1-x, y)
+def test_radial_bl(x, y): return test_radial_tl(x, 1-y)
+def test_radial_br(x, y): return test_radial_tl(1-x, 1-y)
+def test_stripe(x, n): return float(int(x*n) & 1)
+def test_stripe_h_2(x, y): return test_stripe(x, 2)
+def test_stripe_h_4(x, y): return test_stripe(x, 4)
+def test_stripe_h_10(x, y): return test_stripe(x, 10)
+def test_stripe_v_2(x, y): return test_stripe(y, 2)
+def test_stripe_v_4(x, y): return test_stripe(y, 4)
+def test_stripe_v_10(x, y): return test_stripe(y, 10)
+def test_stripe_lr_10(x, y): return test_stripe(x+y, 10)
+def test_stripe_rl_10(x, y): return test_stripe(1+x-y, 10)
+def test_checker(x, y, n): return float((int(x*n) & 1) ^ (int(y*n) & 1))
+def test_checker_8(x, y): return test_checker(x, y, 8)
+def test_checker_15(x, y): return test_checker(x, y, 15)
+def test_zero(x, y): return 0
+def test_one(x, y): return 1
+
+test_patterns = {
+    'GLR': test_gradient_horizontal_lr,
+    'GRL': test_gradient_horizontal_rl,
+    'GTB': test_gradient_vertical_tb,
+    'GBT': test_gradient_vertical_bt,
+    'RTL': test_radial_tl,
+    'RTR': test_radial_tr,
+    'RBL': test_radial_bl,
+    'RBR': test_radial_br,
+    'RCTR': test_radial_center,
+    'HS2': test_stripe_h_2,
+    'HS4': test_stripe_h_4,
+    'HS10': test_stripe_h_10,
+    'VS2': test_stripe_v_2,
+    'VS4': test_stripe_v_4,
+    'VS10': test_stripe_v_10,
+    'LRS': test_stripe_lr_10,
+    'RLS': test_stripe_rl_10,
+    'CK8': test_checker_8,
+    'CK15': test_checker_15,
+    'ZERO': test_zero,
+    'ONE': test_one,
+    }
+
+def test_pattern(width, height, bitdepth, pattern):
+    """Create a single plane (monochrome) test pattern.  Returns a
+    flat row flat pixel array.
     """
 
-    # Below is a big stack of test image generators.
-    # They're all really tiny, so PEP 8 rules are suspended.
-
-    def test_gradient_horizontal_lr(x, y): return x
-    def test_gradient_horizontal_rl(x, y): return 1-x
-    def test_gradient_vertical_tb(x, y): return y
-    def test_gradient_vertical_bt(x, y): return 1-y
-    def test_radial_tl(x, y): return max(1-math.sqrt(x*x+y*y), 0.0)
-    def test_radial_center(x, y): return test_radial_tl(x-0.5, y-0.5)
-    def test_radial_tr(x, y): return test_radial_tl(1-x, y)
-    def test_radial_bl(x, y): return test_radial_tl(x, 1-y)
-    def test_radial_br(x, y): return test_radial_tl(1-x, 1-y)
-    def test_stripe(x, n): return float(int(x*n) & 1)
-    def test_stripe_h_2(x, y): return test_stripe(x, 2)
-    def test_stripe_h_4(x, y): return test_stripe(x, 4)
-    def test_stripe_h_10(x, y): return test_stripe(x, 10)
-    def test_stripe_v_2(x, y): return test_stripe(y, 2)
-    def test_stripe_v_4(x, y): return test_stripe(y, 4)
-    def test_stripe_v_10(x, y): return test_stripe(y, 10)
-    def test_stripe_lr_10(x, y): return test_stripe(x+y, 10)
-    def test_stripe_rl_10(x, y): return test_stripe(1+x-y, 10)
-    def test_checker(x, y, n): return float((int(x*n) & 1) ^ (int(y*n) & 1))
-    def test_checker_8(x, y): return test_checker(x, y, 8)
-    def test_checker_15(x, y): return test_checker(x, y, 15)
-    def test_zero(x, y): return 0
-    def test_one(x, y): return 1
-
-    test_patterns = {
-        'GLR': test_gradient_horizontal_lr,
-        'GRL': test_gradient_horizontal_rl,
-        'GTB': test_gradient_vertical_tb,
-        'GBT': test_gradient_vertical_bt,
-        'RTL': test_radial_tl,
-        'RTR': test_radial_tr,
-        'RBL': test_radial_bl,
-        'RBR': test_radial_br,
-        'RCTR': test_radial_center,
-        'HS2': test_stripe_h_2,
-        'HS4': test_stripe_h_4,
-        'HS10': test_stripe_h_10,
-        'VS2': test_stripe_v_2,
-        'VS4': test_stripe_v_4,
-        'VS10': test_stripe_v_10,
-        'LRS': test_stripe_lr_10,
-        'RLS': test_stripe_rl_10,
-        'CK8': test_checker_8,
-        'CK15': test_checker_15,
-        'ZERO': test_zero,
-        'ONE': test_one,
-        }
-
-    def test_pattern(width, height, bitdepth, pattern):
-        """Create a single plane (monochrome) test pattern.  Returns a
-        flat row flat pixel array.
-        """
-
-        maxval = 2**bitdepth-1
-        if maxval > 255:
-            a = array('H')
-        else:
-            a = array('B')
-        fw = float(width)
-        fh = float(height)
-        pfun = test_patterns[pattern]
-        for y in range(height):
-            fy = float(y)/fh
-            for x in range(width):
-                a.append(int(round(pfun(float(x)/fw, fy) * maxval)))
-        return a
+    maxval = 2**bitdepth-1
+    if maxval > 255:
+        a = array('H')
+    else:
+        a = array('B')
+    fw = float(width)
+    fh = float(height)
+    pfun = test_patterns[pattern]
+    for y in range(height):
+        fy = float(y)/fh
+        for x in range(width):
+            a.append(int(round(pfun(float(x)/fw, fy) * maxval)))
+    return a
+
+def test_rgba(size=256, bitdepth=8,
+                red="GTB", green="GLR", blue="RTL", alpha=None):
+    """
+    Create a test image.  Each channel is generated from the
+    specified pattern; any channel apart from red can be set to
+    None, which will cause it not to be in the image.  It
+    is possible to create all PNG channel types (L, RGB, LA, RGBA),
+    as well as non PNG channel types (RGA, and so on).
+    """
 
-    def test_rgba(size=256, bitdepth=8,
-                    red="GTB", green="GLR", blue="RTL", alpha=None):
-        """
-        Create a test image.  Each channel is generated from the
-        specified pattern; any channel apart from red can be set to
-        None, which will cause it not to be in the image.  It
-        is possible to create all PNG channel types (L, RGB, LA, RGBA),
-        as well as non PNG channel types (RGA, and so on).
-        """
+    i = test_pattern(size, size, bitdepth, red)
+    psize = 1
+    for channel in (green, blue, alpha):
+        if channel:
+            c = test_pattern(size, size, bitdepth, channel)
+            i = interleave_planes(i, c, psize, 1)
+            psize += 1
+    return i
 
-        i = test_pattern(size, size, bitdepth, red)
-        psize = 1
-        for channel in (green, blue, alpha):
-            if channel:
-                c = test_pattern(size, size, bitdepth, channel)
-                i = interleave_planes(i, c, psize, 1)
-                psize += 1
-        return i
+def test_suite(options, args):
+    """
+    Create a PNG test image and write the file to stdout.
+    """
 
     def pngsuite_image(name):
         """
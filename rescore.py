@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+
+# Offline re-scoring of stored CameraFrames.
+#
+# Replays the motion detection pipeline of ImageFetcherTask over the frames
+# already kept in the datastore, once per alternative parameter set, and
+# reports the events each set would have produced.  This is what to use
+# when tuning MODETECT_THRESHOLD, MODETECT_EWMA_ALPHA and friends.
+#
+# Runs outside the application (Python 2.6 or later, for multiprocessing)
+# against the live datastore through remote_api, so app.yaml must have the
+# remote_api builtin enabled.  Example:
+#
+#   rescore.py -a cowguardian.appspot.com -s 2010-06-01T00:00 -e 2010-06-02T00:00 \
+#       -p "live:" -p "t40:threshold=40" -p "slow:ewma_alpha=0.1,threshold=45" \
+#       -o report.csv
+#
+# Only frames that were stored, i.e. those belonging to an event, can be
+# replayed.  Gaps between stored frames are scored as if the frames were
+# consecutive, so a replay is a faithful comparison of parameter sets rather
+# than an exact reproduction of what happened live.
+
+import sys, csv, getpass, optparse, multiprocessing
+from datetime import datetime, timedelta
+
+try:
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+except ImportError:
+    pass
+
+from google.appengine.ext import db
+from google.appengine.ext.remote_api import remote_api_stub
+import modetect, handlers
+from schema import CameraSource, CameraFrame
+
+
+# number of CameraFrames fetched from the datastore per round trip.
+FETCH_BATCH_SIZE = 50
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M"
+
+
+# ----------------------------------------------------------------------
+
+# Parse one --params option of the form "name:key=value,key=value".  Values
+# are converted to the type of the parameter's default (see
+# modetect.parse_param).  Returns (name, overrides).
+def parse_params(spec):
+    name, sep, body = spec.partition(":")
+    if not sep or not name:
+        raise ValueError("parameter set %r must look like name:key=value,..." % spec)
+    overrides = {}
+    for item in filter(None, body.split(",")):
+        key, sep, value = item.partition("=")
+        if not sep:
+            raise ValueError("expected key=value in parameter set %r, got %r" % (name, item))
+        try:
+            overrides[key.strip()] = modetect.parse_param(key.strip(), value.strip())
+        except ValueError, e:
+            raise ValueError("%s in parameter set %r" % (e, name))
+    return (name, overrides)
+
+
+# Build the MotionParams used for a camera: its live settings, as used by
+# ImageFetcherTask, with the parameter set's overrides applied.
+def camera_params(cam, overrides):
+    live = handlers.ImageFetcherTask.motionParams(cam)
+    settings = dict([(name, getattr(live, name)) for name in modetect.MotionParams.defaults])
+    settings.update(overrides)
+    return modetect.MotionParams(**settings)
+
+
+# ----------------------------------------------------------------------
+
+# Follows the event logic of ImageFetcherTask.pollCamera for one parameter
+# set, given the detection result of each frame in time order.
+class EventReplay:
+    def __init__(self, num_secs_after):
+        self.num_secs_after = num_secs_after
+        self.event = None
+        self.events = []
+
+    def add(self, image_time, motion_rating, motion_found):
+        event = self.event
+        if event is not None:
+            event['frames'] += 1
+            event['total_rating'] += motion_rating
+            event['max_rating'] = max(event['max_rating'], motion_rating)
+            event['end'] = image_time
+            if motion_found:
+                event['alarm_frames'] += 1
+                event['last_motion'] = image_time
+
+            td = image_time - event['last_motion']
+            total_seconds = (td.microseconds + (td.seconds + td.days * 24 * 3600) * 10**6) / 10**6
+            if (not motion_found) and (total_seconds > self.num_secs_after):
+                self.event = None
+        elif motion_found:
+            self.event = dict(start=image_time, end=image_time, last_motion=image_time,
+                              frames=1, alarm_frames=1,
+                              max_rating=motion_rating, total_rating=motion_rating)
+            self.events.append(self.event)
+
+
+# Generate the CameraFrames of a camera with start <= image_time < end, in
+# image_time order, fetching them in batches with a query cursor.
+def stream_frames(camkey, start, end):
+    query = CameraFrame.all()
+    query.filter("camera_id =", camkey)
+    query.filter("image_time >=", start)
+    query.filter("image_time <", end)
+    query.order("image_time")
+    while True:
+        batch = query.fetch(FETCH_BATCH_SIZE)
+        for frame in batch:
+            yield frame
+        if len(batch) < FETCH_BATCH_SIZE:
+            break
+        query.with_cursor(query.cursor())
+
+
+# Re-score one camera over one time range with every parameter set.  The
+# thumbnail of each stored frame is produced (and decoded) only once and
+# shared by all the parameter sets that use the same colour mode.
+# Returns a list of (set name, camera name, event) tuples.
+def rescore(job):
+    camkey, start, end, paramsets = job
+    cam = CameraSource.get(db.Key(camkey))
+    engine = modetect.get_engine()
+
+    runs = []
+    for name, overrides in paramsets:
+        runs.append((name, camera_params(cam, overrides), modetect.MotionState(),
+                     EventReplay(cam.num_secs_after)))
+
+    for stored in stream_frames(cam.key(), start, end):
+        thumbnail = handlers.ImageFetcherTask.motionThumbnail(stored.full_size_image)
+        frames = {}
+        for name, params, state, replay in runs:
+            if params.mode not in frames:
+                frames[params.mode] = modetect.prepare_frame(thumbnail, params)
+            frame = frames[params.mode]
+            result = modetect.detect_motion(frame, state, params, engine)
+            replay.add(stored.image_time, result.rating, result.found)
+
+    report = []
+    for name, params, state, replay in runs:
+        for event in replay.events:
+            report.append((name, cam.name, event))
+    return report
+
+
+# ----------------------------------------------------------------------
+
+def auth_func():
+    return (raw_input("Email: "), getpass.getpass("Password: "))
+
+
+# Pool initializer: every worker process talks to the datastore through its
+# own remote_api connection.  Credentials are collected once by the parent.
+def connect(app_id, host, email, password):
+    remote_api_stub.ConfigureRemoteApi(app_id, "/_ah/remote_api", lambda: (email, password), host)
+
+
+# Split [start, end) into consecutive ranges no longer than span.
+def time_ranges(start, end, span):
+    ranges = []
+    while start < end:
+        ranges.append((start, min(start + span, end)))
+        start += span
+    return ranges
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-a", "--host", help="application host, e.g. app-id.appspot.com")
+    parser.add_option("-A", "--app-id", help="application id (default: first label of --host)")
+    parser.add_option("-s", "--start", help="first image_time to replay (%s)" % TIME_FORMAT.replace("%", "%%"))
+    parser.add_option("-e", "--end", help="image_time to stop at (default: now)")
+    parser.add_option("-c", "--camera", action="append", default=[],
+                      help="camera key to replay (repeatable; default: all enabled cameras)")
+    parser.add_option("-p", "--params", action="append", default=[],
+                      help='parameter set "name:key=value,..." (repeatable; "live:" replays the current settings)')
+    parser.add_option("-H", "--split-hours", type="float", default=0,
+                      help="also split each camera into ranges of this many hours; detection "
+                           "state restarts at every range boundary (default: no split)")
+    parser.add_option("-j", "--processes", type="int", default=None,
+                      help="number of worker processes (default: one per CPU)")
+    parser.add_option("-o", "--output", help="CSV report file (default: stdout)")
+    (options, args) = parser.parse_args(argv)
+
+    if not options.host or not options.start:
+        parser.error("--host and --start are required")
+    try:
+        paramsets = [parse_params(spec) for spec in options.params or ["live:"]]
+    except ValueError, e:
+        parser.error(str(e))
+    start = datetime.strptime(options.start, TIME_FORMAT)
+    end = options.end and datetime.strptime(options.end, TIME_FORMAT) or datetime.now()
+    app_id = options.app_id or options.host.split(".")[0]
+
+    email, password = auth_func()
+    connect(app_id, options.host, email, password)
+
+    camkeys = options.camera
+    if not camkeys:
+        query = CameraSource.all().filter("deleted =", False).filter("enabled =", True)
+        camkeys = [str(cam.key()) for cam in query]
+
+    if options.split_hours > 0:
+        ranges = time_ranges(start, end, timedelta(hours=options.split_hours))
+    else:
+        ranges = [(start, end)]
+    jobs = [(camkey, s, e, paramsets) for camkey in camkeys for (s, e) in ranges]
+
+    pool = multiprocessing.Pool(options.processes, connect,
+                                (app_id, options.host, email, password))
+    try:
+        results = pool.map(rescore, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    out = options.output and open(options.output, "wb") or sys.stdout
+    writer = csv.writer(out)
+    writer.writerow(["params", "camera", "event_start", "event_end", "frames",
+                     "alarm_frames", "max_motion_rating", "avg_motion_rating"])
+    for report in results:
+        for name, camname, event in report:
+            writer.writerow([name, camname,
+                             event['start'].strftime("%Y-%m-%d %H:%M:%S"),
+                             event['end'].strftime("%Y-%m-%d %H:%M:%S"),
+                             event['frames'], event['alarm_frames'], event['max_rating'],
+                             event['total_rating'] / event['frames']])
+    if out is not sys.stdout:
+        out.close()
+
+
+# ----------------------------------------------------------------------
+
+# Run the tests from the command line:
+# python -c 'import rescore;rescore.test()'
+
+import unittest
+
+def test():
+    unittest.main(__name__)
+
+class Test(unittest.TestCase):
+    def testParseParams(self):
+        self.assertEqual(parse_params("live:"), ("live", {}))
+        self.assertEqual(parse_params("m:grid=2,mask=0110,ewma_alpha=0.1"),
+                         ("m", dict(grid=2, mask="0110", ewma_alpha=0.1)))
+        self.assertEqual(parse_params("v: background_variance = true "),
+                         ("v", dict(background_variance=True)))
+        self.assertRaises(ValueError, parse_params, "nameless")
+        self.assertRaises(ValueError, parse_params, "m:grid")
+        self.assertRaises(ValueError, parse_params, "m:speed=3")
+        self.assertRaises(ValueError, parse_params, "m:threshold=high")
+
+
+if __name__ == "__main__":
+    main()
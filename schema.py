@@ -18,6 +18,14 @@ class CameraSource(db.Model):
     # TODO: frames before/after event
     num_secs_after = db.FloatProperty(default=2.0, required=True)
     # TODO: sensitivity
+    # motion detection compares "rgb" colour samples or a single "luma" plane.
+    modetect_mode = db.StringProperty(default="rgb", choices=set(["rgb", "luma"]), required=True)
+    # motion is scored against the previous "frame" or a running "background" model.
+    modetect_reference = db.StringProperty(default="frame", choices=set(["frame", "background"]), required=True)
+    # motion detection splits the frame into modetect_grid x modetect_grid tiles.
+    modetect_grid = db.IntegerProperty(default=1, required=True)
+    # one '1' (include) or '0' (exclude) per tile, row-major; empty includes all.
+    modetect_mask = db.StringProperty()
 
 class CameraEvent(db.Model):
     camera_id = db.ReferenceProperty(CameraSource, required=True)